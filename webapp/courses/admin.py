@@ -17,6 +17,8 @@ from reversion.admin import VersionAdmin
 from nested_inline.admin import NestedStackedInline, NestedTabularInline, \
     NestedModelAdmin
 
+import courses.tasks as rpc_tasks
+
 ## User profiles
 # http://stackoverflow.com/questions/4565814/django-user-userprofile-and-admin
 admin.site.unregister(User)
@@ -70,8 +72,8 @@ class FileExerciseTestCommandInline(NestedStackedInline):
         }),
         ('Extra Options', {
             'classes': ('collapse',),
-            'fields': ('significant_stdout', 'significant_stderr', 'timeout', 
-                       'signal', 'input_text', 'return_value')
+            'fields': ('significant_stdout', 'significant_stderr', 'comparison_mode',
+                       'numeric_tolerance', 'timeout', 'signal', 'input_text', 'return_value')
         }),
     )
     inlines = [FileExerciseTestExpectedOutputInline]
@@ -240,13 +242,27 @@ class FileExerciseAdmin(NestedModelAdmin):
     def get_queryset(self, request):
         return self.model.objects.filter(content_type="FILE_UPLOAD_EXERCISE")
 
+    def regrade_answers(self, request, queryset):
+        count = 0
+        for exercise in queryset:
+            answer_ids = UserFileUploadExerciseAnswer.objects.filter(exercise=exercise)\
+                .order_by("id").values_list("id", flat=True)
+            answer_ids = list(answer_ids)
+            rpc_tasks.regrade(exercise.id, answer_ids)
+            count += len(answer_ids)
+        self.message_user(request, "Queued %d answers for regrading." % count)
+    regrade_answers.short_description = "Evaluate all the answers again"
+
     fieldsets = [
         ('Page information',   {'fields': ['name', 'slug', 'content', 'question', 'tags']}),
-        ('Exercise miscellaneous', {'fields': ['default_points', 'manually_evaluated'],
+        ('Exercise miscellaneous', {'fields': ['default_points', 'manually_evaluated',
+                                               'cache_reference_results', 'deduplicate_answers',
+                                               'fail_fast'],
                                 'classes': ['wide']}),
         ('Feedback settings',  {'fields': ['feedback_questions']}),
     ]
     inlines = [HintInline, FileExerciseTestIncludeFileInline, FileExerciseTestInline]
+    actions = ["regrade_answers"]
     search_fields = ("name",)
     readonly_fields = ("slug",)
     list_display = ("name", "slug",)
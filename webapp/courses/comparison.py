@@ -0,0 +1,138 @@
+"""
+Comparison modes for the outputs of file upload exercise commands.
+
+Apart from the exact mode, the outputs are compared line by line as they are
+read, with universal newlines, and the comparison stops at the first line
+that doesn't match. The output diffs use the same normalization, so that
+they don't show the differences the comparison ignores.
+"""
+import io
+import itertools
+import math
+
+EXACT = "EXACT"
+TRAILING_WHITESPACE = "TRAILING_WHITESPACE"
+BLANK_LINES = "BLANK_LINES"
+CASE_INSENSITIVE = "CASE_INSENSITIVE"
+NUMERIC = "NUMERIC"
+
+def iter_lines(text):
+    """Yields the lines of text without line endings, reading it lazily."""
+    for line in io.StringIO(text, newline=None):
+        yield line.rstrip("\n")
+
+def normalize(text, mode):
+    """Yields the lines of text normalized for the comparison mode."""
+    lines = iter_lines(text)
+    if mode == TRAILING_WHITESPACE:
+        return (line.rstrip() for line in lines)
+    if mode == BLANK_LINES:
+        return (line for line in lines if line.strip())
+    if mode == CASE_INSENSITIVE:
+        return (line.casefold() for line in lines)
+    return lines
+
+def _parse_number(token):
+    try:
+        number = float(token)
+    except ValueError:
+        return None
+    return number if math.isfinite(number) else None
+
+def numbers_match(student_line, reference_line, tolerance):
+    """
+    Compares two lines token by token. Numbers match when they are within
+    the tolerance of each other, either absolutely or relatively.
+    """
+    student_tokens = student_line.split()
+    reference_tokens = reference_line.split()
+    if len(student_tokens) != len(reference_tokens):
+        return False
+    for student_token, reference_token in zip(student_tokens, reference_tokens):
+        if student_token == reference_token:
+            continue
+        student_number = _parse_number(student_token)
+        reference_number = _parse_number(reference_token)
+        if student_number is None or reference_number is None:
+            return False
+        if not math.isclose(student_number, reference_number,
+                            rel_tol=tolerance, abs_tol=tolerance):
+            return False
+    return True
+
+def outputs_match(student_output, reference_output, mode=EXACT, tolerance=0.0):
+    """Tells whether the outputs are the same in the given comparison mode."""
+    if mode == EXACT or mode is None:
+        return student_output == reference_output
+
+    if mode == NUMERIC:
+        lines_match = lambda s, r: s == r or numbers_match(s, r, tolerance)
+    else:
+        lines_match = lambda s, r: s == r
+
+    # A missing line is None, which never equals a line
+    for student_line, reference_line in itertools.zip_longest(
+            normalize(student_output, mode), normalize(reference_output, mode)):
+        if student_line is None or reference_line is None:
+            return False
+        if not lines_match(student_line, reference_line):
+            return False
+    return True
+
+class NumericKey(object):
+    """
+    Line key for diffing that rounds the numbers of the line to the
+    tolerance, so that lines whose numbers are close are matched as equal.
+    The rounding can put close numbers into different buckets, so the
+    replaced lines of the diff are checked again with match, which is the
+    rule the comparison uses.
+    """
+
+    def __init__(self, tolerance):
+        self.tolerance = tolerance
+
+    def __repr__(self):
+        return "NumericKey(%r)" % self.tolerance
+
+    def match(self, student_line, reference_line):
+        return student_line == reference_line or \
+            numbers_match(student_line, reference_line, self.tolerance)
+
+    def __call__(self, line):
+        tokens = []
+        for token in line.split():
+            number = _parse_number(token)
+            if number is None:
+                tokens.append(token)
+            elif self.tolerance and math.isfinite(number / self.tolerance):
+                tokens.append("#%d" % round(number / self.tolerance))
+            else:
+                # Too large to round to the tolerance, e.g. 1e308 / 1e-6
+                tokens.append("#%r" % number)
+        return " ".join(tokens)
+
+def diff_lines(text, mode):
+    """Returns the lines of an output to be shown in the diff."""
+    if mode in (TRAILING_WHITESPACE, BLANK_LINES):
+        return list(normalize(text, mode))
+    if mode in (CASE_INSENSITIVE, NUMERIC):
+        return list(iter_lines(text))
+    return text.splitlines()
+
+def diff_key(mode, tolerance=0.0):
+    """
+    Returns the function the diff lines are matched by, or None if they are
+    matched as they are.
+    """
+    if mode == CASE_INSENSITIVE:
+        return str.casefold
+    if mode == NUMERIC:
+        return NumericKey(tolerance)
+    return None
+
+def diff_linematch(key):
+    """
+    Returns the function the replaced diff lines are checked again with, or
+    None if the key is enough.
+    """
+    return getattr(key, "match", None)
@@ -0,0 +1,107 @@
+"""
+Checking the output of file upload exercise commands against the expected
+outputs (FileExerciseTestExpectedOutput) given in the admin.
+
+An expected output marked correct must be found in the command's output,
+and one not marked correct (a typical mistake) must not. Regexp outputs are
+searched for as multiline regular expressions, the others as plain text.
+The hints of the failed expected outputs are shown to the student. An
+expected output that isn't a valid regular expression always fails, so that
+the mistake in the exercise shows up instead of passing every output.
+
+A stream checked against expected outputs isn't compared to the reference
+output, and a test whose outputs are all checked this way doesn't need the
+reference implementation to be run at all.
+"""
+import collections
+import json
+import re
+import threading
+
+STREAMS = ("stdout", "stderr")
+
+Pattern = collections.namedtuple("Pattern", ["correct", "regexp", "hint"])
+
+_MAX_COMPILED = 1024
+
+_compiled = collections.OrderedDict()
+_compiled_lock = threading.Lock()
+
+def get_expected_outputs(cmd, stream):
+    """Returns the expected outputs of a command in the test plan for a stream."""
+    return [output for output in cmd.get("expected_outputs", ())
+            if output["output_type"] == stream.upper()]
+
+def get_patterns(cmd, stream):
+    """
+    Returns the compiled patterns of a command's expected outputs for a
+    stream. The patterns are compiled once per command and kept for the
+    most recently used commands of this process. The regexp of an invalid
+    expected output is None and its hint is the compile error.
+    """
+    outputs = get_expected_outputs(cmd, stream)
+    if not outputs:
+        return []
+
+    key = (cmd["id"], stream, json.dumps(outputs, sort_keys=True))
+    with _compiled_lock:
+        patterns = _compiled.get(key)
+        if patterns is not None:
+            _compiled.move_to_end(key)
+            return patterns
+
+    patterns = []
+    for output in outputs:
+        expression = output["expected_answer"]
+        if not output["regexp"]:
+            expression = re.escape(expression)
+        try:
+            regexp = re.compile(expression, re.MULTILINE)
+        except re.error as e:
+            print("Invalid expected output %d: %s" % (output["id"], e))
+            patterns.append(Pattern(output["correct"], None,
+                                    "Invalid expected output %r: %s" % (output["expected_answer"], e)))
+            continue
+        patterns.append(Pattern(output["correct"], regexp, output["hint"]))
+
+    with _compiled_lock:
+        _compiled[key] = patterns
+        while len(_compiled) > _MAX_COMPILED:
+            _compiled.popitem(last=False)
+    return patterns
+
+def check(cmd, stream, output):
+    """
+    Checks the output of a command against its expected outputs. Returns
+    None if the stream has no expected outputs, otherwise a dict with the
+    verdict and the hints of the expected outputs that failed.
+    """
+    patterns = get_patterns(cmd, stream)
+    if not patterns:
+        return None
+
+    correct = True
+    hints = []
+    for pattern in patterns:
+        if pattern.regexp is None:
+            correct = False
+            hints.append(pattern.hint)
+            continue
+        found = pattern.regexp.search(output) is not None
+        if found != pattern.correct:
+            correct = False
+            if pattern.hint:
+                hints.append(pattern.hint)
+    return {"correct": correct, "hints": hints}
+
+def needs_reference(test):
+    """
+    Tells whether the reference implementation has to be run for a test,
+    i.e. the test has no expected outputs or some of its significant outputs
+    have no expected outputs to check them against.
+    """
+    commands = [cmd for stage in test["stages"] for cmd in stage["commands"]]
+    if not any(cmd.get("expected_outputs") for cmd in commands):
+        return True
+    return any(cmd["significant_" + stream] and not get_expected_outputs(cmd, stream)
+               for cmd in commands for stream in STREAMS)
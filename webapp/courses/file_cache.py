@@ -0,0 +1,76 @@
+"""
+Process-wide, size-bounded LRU cache for the contents of files read from the
+media storage. Entries are keyed by the file path together with its
+modification time and size, so a changed file is always read again.
+"""
+import collections
+import os
+import threading
+
+from django.conf import settings
+
+_DEFAULT_MAX_SIZE = 64 * 1024 * 1024
+
+class FileContentCache:
+    """
+    Keeps the most recently read files in memory until their total size
+    exceeds max_size bytes. Safe to use from several threads.
+    """
+
+    def __init__(self, max_size=_DEFAULT_MAX_SIZE):
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def read(self, path):
+        """Returns the contents of the file at path as bytes."""
+        stat = os.stat(path)
+        key = (path, stat.st_mtime_ns, stat.st_size)
+
+        with self._lock:
+            contents = self._entries.get(key)
+            if contents is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return contents
+            self.misses += 1
+
+        with open(path, "rb") as f:
+            contents = f.read()
+
+        if len(contents) <= self.max_size:
+            with self._lock:
+                if key not in self._entries:
+                    self._entries[key] = contents
+                    self.size += len(contents)
+                while self.size > self.max_size:
+                    _, evicted = self._entries.popitem(last=False)
+                    self.size -= len(evicted)
+        return contents
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_cache():
+    """
+    Returns the cache of this process. The size limit in bytes can be set with
+    FILE_EXERCISE_FILE_CACHE_SIZE in settings.
+    """
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = FileContentCache(
+                getattr(settings, "FILE_EXERCISE_FILE_CACHE_SIZE", _DEFAULT_MAX_SIZE)
+            )
+        return _cache
+
+def read_file(path):
+    return get_cache().read(path)
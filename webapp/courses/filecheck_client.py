@@ -33,17 +33,83 @@ def compose_test_object(exercise):
     """
     Get the exercise related tests from the database and compose an easily
     readable object of them for the Celery task.
+
+    The whole test -> stage -> command -> expected output tree and the
+    included files are fetched with a handful of queries, and the result only
+    contains plain, JSON serializable data, so the tasks never need to touch
+    the database for the individual tests, stages and commands.
     """
-    test_object = {}
-    # TODO: Use select_related to speed up the queries
-    db_tests = FileExerciseTest.objects.filter(exercise=exercise)
+    to_secs = lambda t: ((t.hour * 60 + t.minute) * 60) + t.second + (t.microsecond * 0.000001)
+
+    db_files = FileExerciseTestIncludeFile.objects.filter(exercise=exercise)
+    db_tests = FileExerciseTest.objects.filter(exercise=exercise)\
+        .order_by("id")\
+        .prefetch_related(
+            "required_files",
+            "fileexerciseteststage_set__fileexercisetestcommand_set__fileexercisetestexpectedoutput_set",
+        )
+
+    test_object = {
+        "exercise_id": exercise.id,
+        "default_points": exercise.default_points,
+        "cache_reference_results": exercise.cache_reference_results,
+        "deduplicate_answers": exercise.deduplicate_answers,
+        "fail_fast": exercise.fail_fast,
+        "files": [],
+        "tests": [],
+    }
+
+    for db_file in db_files:
+        test_object["files"].append({
+            "id": db_file.id,
+            "name": db_file.name,
+            "purpose": db_file.purpose,
+            "chown_settings": db_file.chown_settings,
+            "chgrp_settings": db_file.chgrp_settings,
+            "chmod_settings": db_file.chmod_settings,
+            "path": db_file.fileinfo.path,
+        })
+
     for db_test in db_tests:
-        db_stages = FileExerciseTestStage.objects.filter(test=db_test)
-        for db_stage in db_stages:
-            db_cmds = FileExerciseTestCommand.objects.filter(stage=db_stage)
-            for db_cmd in db_cmds:
-                db_outputs = FileExerciseTestExpectedOutput.objects.filter(command=db_cmd)
-    
+        test = {
+            "id": db_test.id,
+            "name": db_test.name,
+            "required_files": sorted(f.id for f in db_test.required_files.all()),
+            "stages": [],
+        }
+        for db_stage in db_test.fileexerciseteststage_set.all():
+            stage = {
+                "id": db_stage.id,
+                "name": db_stage.name,
+                "ordinal_number": db_stage.ordinal_number,
+                "depends_on": db_stage.depends_on_id,
+                "commands": [],
+            }
+            for db_cmd in db_stage.fileexercisetestcommand_set.all():
+                stage["commands"].append({
+                    "id": db_cmd.id,
+                    "command_line": db_cmd.command_line,
+                    "significant_stdout": db_cmd.significant_stdout,
+                    "significant_stderr": db_cmd.significant_stderr,
+                    "comparison_mode": db_cmd.comparison_mode,
+                    "numeric_tolerance": db_cmd.numeric_tolerance,
+                    "timeout": to_secs(db_cmd.timeout),
+                    "signal": db_cmd.signal,
+                    "input_text": db_cmd.input_text,
+                    "return_value": db_cmd.return_value,
+                    "ordinal_number": db_cmd.ordinal_number,
+                    "expected_outputs": [{
+                        "id": db_output.id,
+                        "correct": db_output.correct,
+                        "regexp": db_output.regexp,
+                        "expected_answer": db_output.expected_answer,
+                        "hint": db_output.hint,
+                        "output_type": db_output.output_type,
+                    } for db_output in db_cmd.fileexercisetestexpectedoutput_set.all()],
+                })
+            test["stages"].append(stage)
+        test_object["tests"].append(test)
+
     return test_object
 
 def file_exercise_check(content, user, files_data, post_data):
@@ -0,0 +1,183 @@
+"""
+Management command for benchmarking the output comparison and diff path of
+file upload exercises with synthetic program outputs.
+
+The results are printed as JSON, so that runs on different commits can be
+compared with each other. generate_results only compares the outputs; the
+diffs are timed through render_output_diff, the path of the diff view, with
+an empty diff cache on every run.
+"""
+import datetime
+import json
+import platform
+import random
+import subprocess
+import time
+import tracemalloc
+
+from django.core.management.base import BaseCommand
+
+import prettydiff.diffcache as diffcache
+import prettydiff.difflib as difflib
+import prettydiff.linediff as linediff
+import courses.tasks as rpc_tasks
+
+def make_lines(count, rnd):
+    return ["Step %d: value = %d, total = %d" % (i, rnd.randrange(1000), i * 7)
+            for i in range(count)]
+
+def identical(lines, rnd):
+    return list(lines)
+
+def trailing_whitespace(lines, rnd):
+    return [line + " " for line in lines]
+
+def off_by_one(lines, rnd):
+    # Every line differs, like an answer that starts counting from 1
+    return [line.replace("Step %d:" % i, "Step %d:" % (i + 1), 1)
+            for i, line in enumerate(lines)]
+
+def totally_different(lines, rnd):
+    return ["%08x %s" % (rnd.getrandbits(32), rnd.choice(("error", "warning", "debug")))
+            for _ in lines]
+
+def binary(lines, rnd):
+    # Output that isn't UTF-8 is decoded as cp437
+    data = bytes(rnd.getrandbits(8) for _ in range(sum(len(line) + 1 for line in lines)))
+    text, _ = rpc_tasks.decode_output(data)
+    return text.splitlines()
+
+CASES = (
+    ("identical", identical),
+    ("trailing-whitespace", trailing_whitespace),
+    ("off-by-one", off_by_one),
+    ("totally-different", totally_different),
+    ("binary", binary),
+)
+
+def make_results(student_lines, reference_lines):
+    """Builds test results of a single command, as run_all_tests returns them."""
+    def run(lines):
+        return {1: {"fail": False, "name": "Benchmark", "stages": {1: {
+            "name": "Run", "ordinal_number": 0, "fail": False, "commands": {1: {
+                "command_line": "./benchmark", "ordinal_number": 0,
+                "significant_stdout": True, "significant_stderr": False,
+                "stdout": "\n".join(lines), "stderr": "",
+                "retval": 0, "expected_retval": 0, "timedout": False, "killed": False,
+                "truncated": False, "runtime": 0.0, "input_text": "",
+            }},
+        }}}}
+    return {"student": run(student_lines), "reference": run(reference_lines)}
+
+def get_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"],
+                                       stderr=subprocess.DEVNULL).decode("ascii").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+class Command(BaseCommand):
+    help = "Benchmarks the diffing of file upload exercise outputs and prints the results as JSON"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000],
+                            help="Numbers of output lines to benchmark")
+        parser.add_argument("--cases", nargs="+", choices=[name for name, _ in CASES],
+                            help="Kinds of output pairs to benchmark (all by default)")
+        parser.add_argument("--repeat", type=int, default=3,
+                            help="Number of timed runs, the fastest is reported")
+        parser.add_argument("--difflib-max-lines", type=int, default=2000,
+                            help="Skip the difflib backend above this many differing lines")
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--output", help="Write the JSON into this file instead of stdout")
+
+    def measure(self, operation, repeat):
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            operation()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+
+        tracemalloc.start()
+        try:
+            operation()
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        return best, peak
+
+    def handle(self, *args, **options):
+        cases = [case for case in CASES if not options["cases"] or case[0] in options["cases"]]
+        backends = (
+            ("difflib", difflib.SequenceMatcher, lambda: None),
+            ("patience", linediff.PatienceSequenceMatcher, linediff.PatienceDiffer),
+        )
+
+        results = []
+        for size in options["sizes"]:
+            for case_name, make_student in cases:
+                rnd = random.Random(options["seed"])
+                reference = make_lines(size, rnd)
+                student = make_student(reference, rnd)
+                n_bytes = sum(len(line) + 1 for line in student) + sum(len(line) + 1 for line in reference)
+                n_lines = len(student) + len(reference)
+
+                operations = []
+                for backend, matcher, differ in backends:
+                    if backend == "difflib" and student != reference and size > options["difflib_max_lines"]:
+                        self.stderr.write("Skipping difflib for %s with %d lines" % (case_name, size))
+                        continue
+                    operations.extend([
+                        ("get_opcodes", backend,
+                         lambda m=matcher: m(None, student, reference).get_opcodes()),
+                        ("make_table", backend,
+                         lambda d=differ: difflib.HtmlDiff(differ=d()).make_table(student, reference)),
+                        ("make_table_page", backend,
+                         lambda d=differ: difflib.HtmlDiff(differ=d()).make_table_page(
+                             student, reference, offset=0, hunks=10)),
+                    ])
+                test_results = make_results(student, reference)
+                operations.append(("generate_results", None,
+                                   lambda: rpc_tasks.generate_results(test_results, 0)))
+                # The first page of the diff view, not served from any cache
+                diff_backend = "patience" if rpc_tasks.use_patience_diff() else "difflib"
+                if diff_backend == "difflib" and student != reference and size > options["difflib_max_lines"]:
+                    self.stderr.write("Skipping render_output_diff for %s with %d lines" % (case_name, size))
+                else:
+                    student_output, reference_output = "\n".join(student), "\n".join(reference)
+                    operations.append((
+                        "render_output_diff", diff_backend,
+                        lambda s=student_output, r=reference_output: rpc_tasks.render_output_diff(
+                            "stdout", s, r, cache=diffcache.DiffCache()
+                        ),
+                    ))
+
+                for operation_name, backend, operation in operations:
+                    seconds, peak = self.measure(operation, options["repeat"])
+                    results.append({
+                        "case": case_name,
+                        "lines": size,
+                        "operation": operation_name,
+                        "backend": backend,
+                        "seconds": seconds,
+                        "lines_per_second": n_lines / seconds if seconds else None,
+                        "bytes_per_second": n_bytes / seconds if seconds else None,
+                        "peak_memory": peak,
+                    })
+                    self.stderr.write("%s %d %s %s: %.4f s" % (
+                        case_name, size, operation_name, backend or "", seconds
+                    ))
+
+        report = json.dumps({
+            "commit": get_commit(),
+            "python": platform.python_version(),
+            "timestamp": datetime.datetime.utcnow().isoformat() + "Z",
+            "repeat": options["repeat"],
+            "results": results,
+        }, indent=2)
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                f.write(report)
+        else:
+            self.stdout.write(report)
@@ -0,0 +1,85 @@
+"""
+Management command for evaluating existing answers to a file upload exercise
+again, e.g. after its tests have been fixed.
+"""
+import datetime
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from courses.models import FileUploadExercise, UserFileUploadExerciseAnswer
+import courses.tasks as rpc_tasks
+
+def date_argument(value):
+    parsed = parse_datetime(value)
+    if parsed is None:
+        date = parse_date(value)
+        if date is None:
+            raise ValueError("Not a date: %s" % value)
+        parsed = datetime.datetime(date.year, date.month, date.day)
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed)
+    return parsed
+
+class Command(BaseCommand):
+    help = "Evaluates the answers to a file upload exercise again"
+
+    def add_arguments(self, parser):
+        parser.add_argument("exercise", help="Slug of the file upload exercise")
+        parser.add_argument("--instance", help="Only regrade answers in the course instance with this slug")
+        parser.add_argument("--since", type=date_argument,
+                            help="Only regrade answers given at or after this date (YYYY-MM-DD[ HH:MM])")
+        parser.add_argument("--until", type=date_argument,
+                            help="Only regrade answers given before this date (YYYY-MM-DD[ HH:MM])")
+        parser.add_argument("--batch-size", type=int, help="Number of answers evaluated per task")
+        parser.add_argument("--force", action="store_true",
+                            help="Run the tests even for answers identical to already evaluated ones")
+        parser.add_argument("--no-wait", action="store_true",
+                            help="Only queue the answers, don't wait for them to be evaluated")
+
+    def handle(self, *args, **options):
+        try:
+            exercise = FileUploadExercise.objects.get(slug=options["exercise"])
+        except FileUploadExercise.DoesNotExist as e:
+            raise CommandError("No such file upload exercise: %s" % options["exercise"])
+
+        answers = UserFileUploadExerciseAnswer.objects.filter(exercise=exercise)
+        if options["instance"]:
+            answers = answers.filter(instance__slug=options["instance"])
+        if options["since"]:
+            answers = answers.filter(answer_date__gte=options["since"])
+        if options["until"]:
+            answers = answers.filter(answer_date__lt=options["until"])
+        answer_ids = list(answers.order_by("id").values_list("id", flat=True))
+
+        batches = rpc_tasks.regrade(exercise.id, answer_ids, options["batch_size"], options["force"])
+        self.stdout.write("Queued %d answers in %d batches" % (len(answer_ids), len(batches)))
+        if options["no_wait"] or not batches:
+            return
+
+        start_time = time.time()
+        while True:
+            done = 0
+            finished = 0
+            for batch in batches:
+                if batch.successful():
+                    done += batch.result
+                    finished += 1
+                elif batch.failed():
+                    finished += 1
+                elif batch.state == "PROGRESS":
+                    done += batch.info.get("current", 0)
+
+            elapsed = time.time() - start_time
+            self.stdout.write("%d/%d answers evaluated, %.2f answers/s" % (
+                done, len(answer_ids), done / elapsed if elapsed else 0
+            ))
+            if finished == len(batches):
+                break
+            time.sleep(5)
+
+        failed = sum(1 for batch in batches if batch.failed())
+        if failed:
+            raise CommandError("%d batches failed" % failed)
@@ -10,9 +10,11 @@ import operator
 import re
 import os
 
+from django.conf import settings
 from django.db import models
+from django.core.exceptions import ObjectDoesNotExist, ValidationError
 from django.contrib.auth.models import User
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete, m2m_changed
 from django.core.urlresolvers import reverse
 from django.utils.text import slugify as slugify
 from django.contrib.postgres.fields import ArrayField
@@ -23,6 +25,8 @@ import pygments
 import magic
 
 import courses.tasks as rpc_tasks
+import courses.reference_cache as reference_cache
+import courses.file_cache as file_cache
 
 import feedback.models
 
@@ -335,6 +339,20 @@ class ContentPage(models.Model):
     question = models.TextField(blank=True) # Translate
     manually_evaluated = models.BooleanField(verbose_name="This exercise is evaluated by hand", default=False)
     ask_collaborators = models.BooleanField(verbose_name="Ask the student to list collaborators", default=False)
+    cache_reference_results = models.BooleanField(verbose_name="Reuse the reference results for later answers",
+                                                  default=True,
+                                                  help_text="Disable for file upload exercises whose reference "\
+                                                  "output changes between runs. The results of tests with "\
+                                                  "input generators are cached by the generator's seed.")
+    deduplicate_answers = models.BooleanField(verbose_name="Reuse the evaluation of identical answers",
+                                              default=True,
+                                              help_text="Disable for file upload exercises whose tests "\
+                                              "are nondeterministic, so that every answer is run again. "\
+                                              "Exercises with input generators are never deduplicated.")
+    fail_fast = models.BooleanField(verbose_name="Stop testing after the first failed test",
+                                    default=False,
+                                    help_text="The rest of the tests of a file upload exercise "\
+                                    "are skipped once a test fails.")
 
     def rendered_markup(self, request=None, context=None, revision=None):
         """
@@ -839,10 +857,26 @@ class FileUploadExercise(ContentPage):
         return answer_object
 
     def check_answer(self, user, ip, answer, files, answer_object, revision):
-        result = rpc_tasks.run_tests.delay(user_id=user.id, exercise_id=self.id,
-                                           answer_id=answer_object.id)
+        result = rpc_tasks.run_tests.apply_async(
+            kwargs={"user_id": user.id, "exercise_id": self.id, "answer_id": answer_object.id},
+            queue=self.get_grading_lane(user)
+        )
         return {"task_id": result.task_id}
 
+    def get_grading_lane(self, user):
+        """
+        Answers by staff and answers given less than
+        FILE_EXERCISE_URGENT_DEADLINE_WINDOW seconds (an hour by default)
+        before a deadline of this exercise jump the queue of live answers.
+        """
+        if user.is_staff:
+            return "urgent"
+        window = datetime.timedelta(seconds=getattr(settings, "FILE_EXERCISE_URGENT_DEADLINE_WINDOW", 60 * 60))
+        now = datetime.datetime.now()
+        if ContentGraph.objects.filter(content=self, deadline__gte=now, deadline__lte=now + window).exists():
+            return "urgent"
+        return "live"
+
     def get_user_evaluation(self, user):
         evaluations = Evaluation.objects.filter(useranswer__userfileuploadexerciseanswer__exercise=self, useranswer__user=user)
         if not evaluations:
@@ -1000,6 +1034,19 @@ class FileExerciseTestStage(models.Model):
     def __str__(self):
         return "%s: %02d - %s" % (self.test.name, self.ordinal_number, self.name)
 
+    def clean(self):
+        # A test can only start from the snapshot of another test's stage
+        if self.depends_on_id is None or self.test_id is None:
+            return
+        if self.depends_on.test_id == self.test_id:
+            raise ValidationError({"depends_on": "A stage can't depend on a stage of its own test."})
+        earlier_stages = FileExerciseTestStage.objects.filter(
+            test_id=self.test_id, ordinal_number__lt=self.ordinal_number
+        ).exclude(id=self.id)
+        if earlier_stages.exists():
+            raise ValidationError({"depends_on": "Only the first stage of a test can depend on "
+                                                 "a stage of another test."})
+
     class Meta:
         unique_together = ('test', 'ordinal_number')
         ordering = ['ordinal_number']
@@ -1030,6 +1077,19 @@ class FileExerciseTestCommand(models.Model):
     input_text = models.TextField(verbose_name="Input fed to the command through STDIN",blank=True,
                                   help_text="What input shall be entered to the program's stdin upon execution?")
     return_value = models.IntegerField(verbose_name='Expected return value',blank=True,null=True)
+    COMPARISON_MODE_CHOICES = (
+        ('EXACT', "Exact"),
+        ('TRAILING_WHITESPACE', "Ignore trailing whitespace and line endings"),
+        ('BLANK_LINES', "Ignore blank lines"),
+        ('CASE_INSENSITIVE', "Ignore case"),
+        ('NUMERIC', "Compare numbers with tolerance"),
+    )
+    comparison_mode = models.CharField(max_length=20,default="EXACT",choices=COMPARISON_MODE_CHOICES,
+                                       help_text="How the outputs are compared to the reference outputs.")
+    numeric_tolerance = models.FloatField(default=1e-6,
+                                          help_text="Largest absolute or relative difference "\
+                                          "between numbers that are considered equal when "\
+                                          "comparing numbers with tolerance.")
     ordinal_number = models.PositiveSmallIntegerField() # TODO: Enforce min=1
 
     def __str__(self):
@@ -1121,14 +1181,35 @@ class FileExerciseTestIncludeFile(models.Model):
         return os.path.basename(self.fileinfo.name)
 
     def get_file_contents(self):
-        file_contents = None
-        with open(self.fileinfo.path, 'rb') as f:
-            file_contents = f.read()
-        return file_contents
+        # Served from the worker's memory when the file hasn't changed
+        return file_cache.read_file(self.fileinfo.path)
 
     class Meta:
         verbose_name = "included file"
 
+def invalidate_reference_cache(sender, instance, **kwargs):
+    """Drops the cached reference results when an exercise's tests are edited."""
+    try:
+        if isinstance(instance, FileExerciseTestCommand):
+            exercise_id = instance.stage.test.exercise_id
+        elif isinstance(instance, FileExerciseTestStage):
+            exercise_id = instance.test.exercise_id
+        else:
+            exercise_id = instance.exercise_id
+    except ObjectDoesNotExist:
+        # Cascaded delete, the deleted parent invalidates the cache
+        return
+    reference_cache.invalidate(exercise_id)
+
+for model in (FileExerciseTest, FileExerciseTestStage, FileExerciseTestCommand,
+              FileExerciseTestIncludeFile):
+    post_save.connect(invalidate_reference_cache, sender=model,
+                      dispatch_uid="invalidate_reference_cache_save_%s" % model.__name__)
+    post_delete.connect(invalidate_reference_cache, sender=model,
+                        dispatch_uid="invalidate_reference_cache_delete_%s" % model.__name__)
+m2m_changed.connect(invalidate_reference_cache, sender=FileExerciseTest.required_files.through,
+                    dispatch_uid="invalidate_reference_cache_required_files")
+
 # TODO: Create a superclass for exercise answer choices
 ## Answer models
 @reversion.register()
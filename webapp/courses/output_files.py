@@ -0,0 +1,128 @@
+"""
+Capturing and comparing the files generated by the programs in file upload
+exercise tests.
+
+The names of the files a test expects are given by its OUTPUT include files.
+After a test has been run, the generated files are moved out of the test
+directory and described in the results by their size and SHA-256 hash, which
+are computed while streaming the file. The student's file is compared to the
+one generated by the reference implementation, or to the OUTPUT file itself
+if the reference run didn't produce it. The files are only read as a whole to
+diff them when the hashes differ and they are small enough.
+"""
+import difflib
+import hashlib
+import os
+import shutil
+import threading
+
+from django.conf import settings
+
+CHUNK_SIZE = 64 * 1024
+
+# Lines of a diff kept in the results
+MAX_DIFF_LINES = 200
+
+_expected_hashes = {}
+_expected_hashes_lock = threading.Lock()
+
+def hash_file(path):
+    """Returns the SHA-256 hash and the size of a file without reading it whole."""
+    h = hashlib.sha256()
+    size = 0
+    with open(path, "rb") as fd:
+        for chunk in iter(lambda: fd.read(CHUNK_SIZE), b""):
+            h.update(chunk)
+            size += len(chunk)
+    return h.hexdigest(), size
+
+def get_expected_hash(path):
+    """
+    Returns the hash and the size of an OUTPUT include file. They are kept in
+    memory by path and replaced when the file changes, so there's one entry
+    per file.
+    """
+    stat = os.stat(path)
+    version = (stat.st_mtime_ns, stat.st_size)
+    with _expected_hashes_lock:
+        cached = _expected_hashes.get(path)
+    if cached is None or cached[0] != version:
+        cached = (version, hash_file(path))
+        with _expected_hashes_lock:
+            _expected_hashes[path] = cached
+    return cached[1]
+
+def get_diff_limit():
+    """
+    Returns the maximum size in bytes of the generated files that are diffed,
+    set with FILE_EXERCISE_OUTPUT_FILE_DIFF_LIMIT in settings.
+    """
+    return getattr(settings, "FILE_EXERCISE_OUTPUT_FILE_DIFF_LIMIT", 256 * 1024)
+
+def capture(test_dir, names, capture_dir):
+    """
+    Moves the files with the given names from the test directory into
+    capture_dir and returns their descriptions keyed by name. Files the
+    program didn't generate are None.
+    """
+    os.makedirs(capture_dir, exist_ok=True)
+    captured = {}
+    for name in names:
+        path = os.path.join(test_dir, name)
+        if not os.path.isfile(path):
+            captured[name] = None
+            continue
+        captured_path = os.path.join(capture_dir, name)
+        shutil.move(path, captured_path)
+        sha256, size = hash_file(captured_path)
+        captured[name] = {"sha256": sha256, "size": size}
+    return captured
+
+def _read_lines(path):
+    with open(path, "rb") as fd:
+        return fd.read().decode("utf-8", "replace").splitlines()
+
+def diff_files(student_path, expected_path):
+    """
+    Returns a unified diff between the expected and the student's file, or
+    None if either of them is too large to be diffed.
+    """
+    limit = get_diff_limit()
+    if os.path.getsize(student_path) > limit or os.path.getsize(expected_path) > limit:
+        return None
+    lines = list(difflib.unified_diff(
+        _read_lines(expected_path), _read_lines(student_path),
+        "expected", "yours", lineterm=""
+    ))
+    if len(lines) > MAX_DIFF_LINES:
+        lines = lines[:MAX_DIFF_LINES] + ["..."]
+    return "\n".join(lines)
+
+def compare(student_t, reference_t, expected_paths, student_dir, reference_dir):
+    """
+    Compares the files captured in the student's run of a test to those of
+    the reference run, falling back to the OUTPUT include files given by
+    name in expected_paths. The verdict is added to the descriptions of the
+    student's files.
+    """
+    reference_files = (reference_t or {}).get("output_files", {})
+    student_files = student_t.get("output_files", {})
+    for name, student_f in list(student_files.items()):
+        reference_f = reference_files.get(name)
+        if reference_f is not None:
+            expected_sha256 = reference_f["sha256"]
+            expected_path = os.path.join(reference_dir, name)
+        elif name in expected_paths:
+            expected_sha256, _ = get_expected_hash(expected_paths[name])
+            expected_path = expected_paths[name]
+        else:
+            continue
+
+        if student_f is None:
+            student_files[name] = {"missing": True, "matches": False, "diff": None}
+            continue
+        student_f["matches"] = student_f["sha256"] == expected_sha256
+        student_f["diff"] = None
+        if not student_f["matches"] and os.path.isfile(expected_path):
+            # The reference file isn't available if its results were cached
+            student_f["diff"] = diff_files(os.path.join(student_dir, name), expected_path)
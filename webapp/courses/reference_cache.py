@@ -0,0 +1,103 @@
+"""
+Cache for the results of running the reference implementation of file upload
+exercise tests.
+
+The reference output only changes when the test configuration or the included
+files change, so the results are stored under a fingerprint computed from the
+test's part of the test plan and the bytes of the files used by the test.
+"""
+import hashlib
+import json
+
+from django.conf import settings
+from django.core.cache import caches
+
+import courses.file_cache as file_cache
+
+def get_cache():
+    """
+    Returns the Django cache backend used for the reference results. The alias
+    can be set with FILE_EXERCISE_CACHE in settings.
+    """
+    return caches[getattr(settings, "FILE_EXERCISE_CACHE", "default")]
+
+def is_cacheable(test_plan):
+    """
+    Reference results are cached unless caching is disabled for the exercise.
+    The inputs of tests with an input generator depend only on the seed,
+    which is part of the fingerprint, so their results are cached by seed.
+    """
+    return test_plan["cache_reference_results"]
+
+def test_fingerprint(test, include_files, parent_fingerprint=None, seed=None):
+    """
+    Computes a content hash of everything that affects the reference results
+    of the given test in the test plan. Tests started from the snapshot of
+    another test's stage must pass the fingerprint of that test as
+    parent_fingerprint. Tests with an input generator must pass the seed
+    their inputs were generated with.
+    """
+    used_files = sorted(
+        (f for f in include_files
+         if f["purpose"] == "REFERENCE" or f["id"] in test["required_files"]),
+        key=lambda f: f["id"]
+    )
+
+    h = hashlib.sha256()
+    if parent_fingerprint is not None:
+        h.update(parent_fingerprint.encode("ascii"))
+    if seed is not None:
+        h.update(("seed:%d" % seed).encode("ascii"))
+    h.update(json.dumps(test, sort_keys=True).encode("utf-8"))
+    for f in used_files:
+        file_info = {key: value for key, value in f.items() if key != "path"}
+        h.update(json.dumps(file_info, sort_keys=True).encode("utf-8"))
+        h.update(hashlib.sha256(file_cache.read_file(f["path"])).digest())
+    return h.hexdigest()
+
+def _generation_key(exercise_id):
+    return "reference-results-generation:%d" % exercise_id
+
+def _results_key(exercise_id, fingerprint):
+    generation = get_cache().get(_generation_key(exercise_id), 0)
+    return "reference-results:%d:%d:%s" % (exercise_id, generation, fingerprint)
+
+def get_results(exercise_id, fingerprint):
+    """Returns the cached reference results or None if there are none."""
+    return get_cache().get(_results_key(exercise_id, fingerprint))
+
+def has_timeouts(results):
+    """
+    Tells whether any command in the results timed out. Such results aren't
+    cached, since a timeout may have been caused by a busy worker. Accepts
+    the results of tests by test id, or the student and reference results of
+    an answer. Tests without reference results are None.
+    """
+    if "student" in results:
+        return has_timeouts(results["student"]) or has_timeouts(results["reference"])
+    return any(cmd["timedout"]
+               for test_results in results.values() if test_results is not None
+               for stage in test_results["stages"].values()
+               for cmd in stage["commands"].values())
+
+def set_results(exercise_id, fingerprint, results):
+    """
+    Stores the reference results of a test, unless a command timed out.
+    """
+    if has_timeouts(results):
+        return
+    timeout = getattr(settings, "FILE_EXERCISE_REFERENCE_CACHE_TIMEOUT", None)
+    get_cache().set(_results_key(exercise_id, fingerprint), results, timeout)
+
+def invalidate(exercise_id):
+    """
+    Makes all the cached reference results of an exercise unreachable by
+    moving the exercise to a new key generation.
+    """
+    cache = get_cache()
+    key = _generation_key(exercise_id)
+    cache.add(key, 0, None)
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, 1, None)
@@ -0,0 +1,114 @@
+"""
+Short-lived store for the rendered evaluations of file upload exercise answers.
+
+The checking task saves the evaluation tree under its task id and the progress
+view picks it up once when the task is ready. The trees are stored as
+compressed, compact JSON.
+
+Each answer is therefore written twice: the raw test results go to the
+database (Evaluation.test_results) and the rendered tree goes here. The
+database copy is the permanent one. Resubmission deduplication, the output
+diff view and old answers are all rendered from it. The copy here only spares
+the first view from parsing the raw results and building the tree again. It
+is deleted when read and expires after a while, and the view falls back to
+the database without it.
+
+The task also publishes a notification on each step of its progress, which
+the progress view waits for instead of being polled repeatedly.
+"""
+import json
+import threading
+import time
+import zlib
+
+import redis
+
+from django.conf import settings
+from django.utils.functional import cached_property
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_client():
+    """
+    Returns a Redis client that shares the connection pool of this process.
+    The server is set with FILE_EXERCISE_RESULT_REDIS_URL in settings.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = redis.ConnectionPool.from_url(
+                getattr(settings, "FILE_EXERCISE_RESULT_REDIS_URL", "redis://localhost:6379/0")
+            )
+    return redis.StrictRedis(connection_pool=_pool)
+
+def _key(task_id):
+    return "file-exercise-evaluation:%s" % task_id
+
+class StoredEvaluation:
+    """
+    An evaluation read from the store. It is decompressed and parsed only
+    when used.
+    """
+
+    def __init__(self, data):
+        self.data = data
+
+    @cached_property
+    def json(self):
+        return zlib.decompress(self.data).decode("utf-8")
+
+    @cached_property
+    def tree(self):
+        return json.loads(self.json)
+
+def save(task_id, evaluation):
+    """
+    Stores the evaluation of a task. It expires after
+    FILE_EXERCISE_RESULT_TIMEOUT seconds (one hour by default).
+    """
+    data = zlib.compress(json.dumps(evaluation, separators=(",", ":")).encode("utf-8"))
+    timeout = getattr(settings, "FILE_EXERCISE_RESULT_TIMEOUT", 60 * 60)
+    get_client().set(_key(task_id), data, ex=timeout)
+
+def load(task_id):
+    """
+    Removes the evaluation of a task from the store and returns it as a
+    StoredEvaluation, or None if it has expired or was already read.
+    """
+    pipe = get_client().pipeline()
+    pipe.get(_key(task_id))
+    pipe.delete(_key(task_id))
+    data, _ = pipe.execute()
+    if data is None:
+        return None
+    return StoredEvaluation(data)
+
+def _channel(task_id):
+    return "file-exercise-progress:%s" % task_id
+
+def publish_progress(task_id):
+    """Notifies the views waiting for the progress of a task."""
+    get_client().publish(_channel(task_id), "progress")
+
+def wait_for_progress(task_id, timeout, is_updated):
+    """
+    Waits until the progress of a task is published or timeout seconds have
+    passed. is_updated is called after subscribing, so that an update made
+    just before the subscription isn't missed; if it returns True, there is
+    no need to wait. Returns True if there was an update.
+    """
+    pubsub = get_client().pubsub(ignore_subscribe_messages=True)
+    try:
+        pubsub.subscribe(_channel(task_id))
+        if is_updated():
+            return True
+        deadline = time.time() + timeout
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            if pubsub.get_message(timeout=remaining) is not None:
+                return True
+    finally:
+        pubsub.close()
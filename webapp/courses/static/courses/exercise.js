@@ -83,23 +83,23 @@ function exercise_error(status, type, error_div, form_parent) {
 }
 
 // http://techoctave.com/c7/posts/60-simple-long-polling-example-with-javascript-and-jquery
+// The server holds the request until the checking progresses, so the next
+// request can be sent right away.
 function poll_progress(url, context) {
     // TODO: End polling after a timeout
-    setTimeout(function() {
-        $.ajax({
-            url: url,
-            context: context,
-            success: function(data, text_status, jqxhr_obj) {
-                var result_div = $(this).children("div.result");
-                var error_div = $(this).children("div.error");
-                exercise_success(data, result_div, error_div, $(this));
-            },
-            error: function(xhr, status, type) {
-                var error_div = $(this).children("div.error");
-                exercise_error(status, type, error_div, $(this));
-            }
-        });
-    }, 500);
+    $.ajax({
+        url: url,
+        context: context,
+        success: function(data, text_status, jqxhr_obj) {
+            var result_div = $(this).children("div.result");
+            var error_div = $(this).children("div.error");
+            exercise_success(data, result_div, error_div, $(this));
+        },
+        error: function(xhr, status, type) {
+            var error_div = $(this).children("div.error");
+            exercise_error(status, type, error_div, $(this));
+        }
+    });
 }
 
 // TODO: WebSockets – maybe use Tornado as the backend?
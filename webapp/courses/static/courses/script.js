@@ -133,6 +133,19 @@ function activate_test_tab(tab_id, elem) {
     item.show();
 }
 
+function show_output_diff(e, elem) {
+    e.preventDefault();
+    var diff_div = $(elem).parent();
+    $.get(elem.href, function(data, textStatus, jqXHR) {
+        diff_div.html(data);
+    });
+}
+
+function toggle_diff_fold(e, elem) {
+    e.preventDefault();
+    $(elem).closest("tbody").prev("tbody.diff-fold").toggle();
+}
+
 function accept_cookies() {
     document.cookie = "cookies_accepted=1";
     var cookie_law_message = $('#cookie-law-message');
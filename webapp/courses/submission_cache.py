@@ -0,0 +1,66 @@
+"""
+Deduplication of identical answers to file upload exercises.
+
+An answer is identified by a fingerprint of the returned files together with
+the version of the exercise's test plan, i.e. a hash of the plan and the
+contents of its include files. When an answer with the same fingerprint has
+already been evaluated, its results are copied instead of running the tests.
+"""
+import hashlib
+import json
+
+from django.conf import settings
+
+import courses.file_cache as file_cache
+import courses.reference_cache as reference_cache
+
+def is_cacheable(test_plan):
+    """
+    Answers aren't deduplicated if the exercise is marked nondeterministic or
+    uses input generators.
+    """
+    if not test_plan["deduplicate_answers"]:
+        return False
+    return not any(f["purpose"] == "INPUTGEN" for f in test_plan["files"])
+
+def plan_fingerprint(test_plan):
+    """Computes a content hash of the test plan and its include files."""
+    h = hashlib.sha256()
+    for f in sorted(test_plan["files"], key=lambda f: f["id"]):
+        h.update(hashlib.sha256(file_cache.read_file(f["path"])).digest())
+    plan = dict(test_plan, files=[
+        {key: value for key, value in f.items() if key != "path"}
+        for f in test_plan["files"]
+    ])
+    h.update(json.dumps(plan, sort_keys=True).encode("utf-8"))
+    return h.hexdigest()
+
+def submission_fingerprint(test_plan, files):
+    """
+    Computes the fingerprint of an answer from the returned files, given as
+    a dict of file names and contents, and the test plan.
+    """
+    h = hashlib.sha256()
+    h.update(plan_fingerprint(test_plan).encode("ascii"))
+    for name in sorted(files.keys()):
+        h.update(hashlib.sha256(name.encode("utf-8")).digest())
+        h.update(hashlib.sha256(files[name]).digest())
+    return h.hexdigest()
+
+def _key(exercise_id, fingerprint):
+    return "answer-evaluation:%d:%s" % (exercise_id, fingerprint)
+
+def get_evaluation_id(exercise_id, fingerprint):
+    """
+    Returns the id of the Evaluation whose results can be copied for an
+    answer with the given fingerprint, or None.
+    """
+    return reference_cache.get_cache().get(_key(exercise_id, fingerprint))
+
+def set_evaluation_id(exercise_id, fingerprint, evaluation_id):
+    """
+    Records the evaluation of an answer for
+    FILE_EXERCISE_ANSWER_CACHE_TIMEOUT seconds (a week by default).
+    """
+    timeout = getattr(settings, "FILE_EXERCISE_ANSWER_CACHE_TIMEOUT", 7 * 24 * 60 * 60)
+    reference_cache.get_cache().set(_key(exercise_id, fingerprint), evaluation_id, timeout)
@@ -6,29 +6,43 @@ replace exercises.
 from __future__ import absolute_import
 
 from collections import namedtuple
+import collections
+from django.conf import settings
 from django.contrib.auth.models import User
 
-import redis
-
 import json
 
 # Result generation dependencies
 import prettydiff.difflib as difflib
+import prettydiff.linediff as linediff
+import prettydiff.diffcache as diffcache
+import hashlib
 
 # Test dependencies
 import tempfile
 import os
 import random
+import concurrent.futures
+import threading
+import shutil
 
 # Stage dependencies
 import base64
+import io
 
 # Command dependencies
 import time
 import shlex
 import subprocess
+import signal
+import resource
+import math
+import selectors
 
-from celery import shared_task, chain
+from celery import shared_task, chain, group, current_app
+from celery.signals import task_postrun, worker_ready, worker_shutdown, worker_process_shutdown
+from redis.exceptions import RedisError
+from django.db import transaction
 
 # The test data
 #from courses.models import FileExerciseTest, FileExerciseTestStage,\
@@ -44,13 +58,27 @@ from celery import shared_task, chain
     #FileUploadExerciseReturnFile
 
 import courses.models
+import courses.reference_cache as reference_cache
+import courses.workspace as workspace
+import courses.file_cache as file_cache
+import courses.result_store as result_store
+import courses.submission_cache as submission_cache
+import courses.worker_health as worker_health
+import courses.expected_output as expected_output
+import courses.output_files as output_files
+import courses.comparison as comparison
 
 # TODO: Improve by following the guidelines here:
 #       - https://news.ycombinator.com/item?id=7909201
 
 @shared_task(name="courses.run-fileexercise-tests", bind=True,
              serializer='json')
-def run_tests(self, user_id, exercise_id, answer_id):
+def run_tests(self, user_id, exercise_id, answer_id, force=False):
+    """
+    Runs the tests of a file upload exercise for an answer and saves the
+    evaluation. Unless force is set, an answer identical to an earlier one
+    gets a copy of the earlier results.
+    """
     # TODO: Actually, just receive the relevant ids for fetching the Django
     #       models here instead of in the Django view.
     # http://celery.readthedocs.org/en/latest/userguide/tasks.html#database-transactions
@@ -62,19 +90,6 @@ def run_tests(self, user_id, exercise_id, answer_id):
     # reference_files: the reference files - these will be tested the same way
     #                  as the student's files
 
-    # TODO: Check if any input generators are used. If yes, find a way to supply
-    #       the same generated input to both the student's and reference codes.
-    #       Some possibilities:
-    #       - Generate a seed _here_ and pass it on (wastes CPU time?)
-    #       - Generate the inputs _here_ and pass them on (best guess)
-    #       - Generate the inputs during the code evaluation process and have
-    #         the other code set depend on them (complicated to implement)
-    # TODO: Input generator targets:
-    #       - stdin
-    #       - readable file
-    #       - as command line parameters!
-    #       - in env?
-
     try:
         exercise_object = courses.models.FileUploadExercise.objects.get(id=exercise_id)
     except courses.models.FileUploadExercise.DoesNotExist as e:
@@ -85,59 +100,45 @@ def run_tests(self, user_id, exercise_id, answer_id):
     user_object = User.objects.get(id=user_id)
     print("user: %s" % (user_object.username))
     
-    # Get the test data
-    # TODO: Use prefetch_related?
-    
-    tests = courses.models.FileExerciseTest.objects.filter(exercise=exercise_id)
+    # Get the whole test tree at once
+    from courses.filecheck_client import compose_test_object
+    test_plan = compose_test_object(exercise_object)
 
-    student_results = {}
-    reference_results = {}
-    
-    # Run all the tests for both the returned and reference code
-    for i, test in enumerate(tests):
-        self.update_state(state="PROGRESS", meta={"current": i, "total": len(tests)})
-
-        # TODO: The student's code can be run in parallel with the reference
-        results = run_test(test.id, answer_id, exercise_id, student=True)
-        student_results.update(results)
-        results = run_test(test.id, answer_id, exercise_id)
-        reference_results.update(results)
+    try:
+        answer_object = courses.models.UserFileUploadExerciseAnswer.objects.get(id=answer_id)
+    except courses.models.UserFileUploadExerciseAnswer.DoesNotExist as e:
+        # TODO: Log weird request
+        return # TODO: Find a way to signal the failure to the user
 
-    #print(student_results.items())
-    #print(reference_results.items())
+    # Read the files under test only once for all the tests
+    # Note: requires a shared/cloned file system!
+    student_files = answer_object.get_returned_files_raw()
+    print("".join("%s:\n%s" % (n, c) for n, c in student_files.items()))
 
-    results = {"student": student_results, "reference": reference_results}
+    results, result_string, submission_fingerprint = get_answer_results(
+        self, test_plan, student_files, force
+    )
 
-    # TODO: Make the comparisons to determine correct status
     # Ultimate encoding: http://en.wikipedia.org/wiki/Code_page_437
     # Determine the result and generate JSON accordingly
-    # TODO: Do this concurrently, interleaved with the actual test running!
     evaluation = generate_results(results, exercise_id)
 
-    # Save the rendered results into Redis
-    # TODO: How to access CELERY_RESULT_BACKEND in settings?
-    task_id = self.request.id
-    r = redis.StrictRedis(host='localhost', port=6379, db=0)
-    r.set(task_id, json.dumps(evaluation))
+    # Save the rendered results for the progress view, which would otherwise
+    # have to render them again from the raw results saved below
+    result_store.save(self.request.id, evaluation)
 
     # Save the results to database
-    result_string = json.dumps(results)
-    correct = evaluation["correct"]
-    points = exercise_object.default_points
-    
     evaluation_obj = courses.models.Evaluation(test_results=result_string,
-                                               points=points,
-                                               correct=correct)
+                                               points=test_plan["default_points"],
+                                               correct=evaluation["correct"])
     evaluation_obj.save()
-    
-    try:
-        answer_object = courses.models.UserFileUploadExerciseAnswer.objects.get(id=answer_id)
-    except courses.models.UserFileUploadExerciseAnswer.DoesNotExist as e:
-        # TODO: Log weird request
-        return # TODO: Find a way to signal the failure to the user
+
     answer_object.evaluation = evaluation_obj
     answer_object.save()
 
+    if submission_fingerprint is not None and not reference_cache.has_timeouts(results):
+        submission_cache.set_evaluation_id(exercise_id, submission_fingerprint, evaluation_obj.id)
+
     return evaluation_obj.id
     
     # TODO: Should we:
@@ -145,6 +146,359 @@ def run_tests(self, user_id, exercise_id, answer_id):
     # - save the results directly into db? (is this worker contained enough?)
     # - send the results to a more privileged Celery worker for saving into db?
 
+@shared_task(name="courses.regrade-answers", bind=True, serializer='json',
+             rate_limit=getattr(settings, "FILE_EXERCISE_REGRADE_RATE_LIMIT", "10/m"))
+def regrade_answers(self, exercise_id, answer_ids, force=False):
+    """
+    Evaluates a batch of existing answers to a file upload exercise again,
+    e.g. after its tests have been fixed. The new evaluations are saved in a
+    single transaction once the whole batch has been run. Returns the number
+    of answers evaluated.
+    """
+    try:
+        exercise_object = courses.models.FileUploadExercise.objects.get(id=exercise_id)
+    except courses.models.FileUploadExercise.DoesNotExist as e:
+        return 0
+
+    from courses.filecheck_client import compose_test_object
+    test_plan = compose_test_object(exercise_object)
+
+    answers = courses.models.UserFileUploadExerciseAnswer.objects.filter(id__in=answer_ids)
+    evaluated = []
+    for i, answer_object in enumerate(answers):
+        self.update_state(state="PROGRESS", meta={"current": i, "total": len(answer_ids)})
+        results, result_string, submission_fingerprint = get_answer_results(
+            None, test_plan, answer_object.get_returned_files_raw(), force
+        )
+        evaluation = generate_results(results, exercise_id)
+        evaluation_obj = courses.models.Evaluation(test_results=result_string,
+                                                   points=test_plan["default_points"],
+                                                   correct=evaluation["correct"])
+        evaluated.append((answer_object, evaluation_obj, results, submission_fingerprint))
+
+    with transaction.atomic():
+        for answer_object, evaluation_obj, _, _ in evaluated:
+            evaluation_obj.save()
+            answer_object.evaluation = evaluation_obj
+            answer_object.save(update_fields=["evaluation"])
+
+    for answer_object, evaluation_obj, results, submission_fingerprint in evaluated:
+        if submission_fingerprint is not None and not reference_cache.has_timeouts(results):
+            submission_cache.set_evaluation_id(exercise_id, submission_fingerprint, evaluation_obj.id)
+
+    return len(evaluated)
+
+def regrade(exercise_id, answer_ids, batch_size=None, force=False):
+    """
+    Queues the given answers to a file upload exercise for regrading in
+    batches of FILE_EXERCISE_REGRADE_BATCH_SIZE answers. The first batch is
+    run alone to fill the reference result cache, after which the rest are
+    spread over the workers. Returns the results of the batch tasks, or an
+    empty list if there was nothing to regrade.
+
+    The batches go to the bulk lane and are throttled with
+    FILE_EXERCISE_REGRADE_RATE_LIMIT (batches per worker per time unit), so
+    that they don't hold up live answers.
+    """
+    batch_size = batch_size or getattr(settings, "FILE_EXERCISE_REGRADE_BATCH_SIZE", 20)
+    answer_ids = list(answer_ids)
+    batches = [answer_ids[i:i + batch_size] for i in range(0, len(answer_ids), batch_size)]
+    if not batches:
+        return []
+
+    signatures = [regrade_answers.si(exercise_id, batch, force).set(queue="bulk")
+                  for batch in batches]
+
+    if len(signatures) == 1:
+        return [signatures[0].apply_async()]
+    job = chain(signatures[0], group(signatures[1:])).apply_async()
+    return [job.parent] + list(job.results)
+
+@task_postrun.connect(sender=run_tests, dispatch_uid="publish_run_tests_done")
+def publish_run_tests_done(task_id=None, **kwargs):
+    """
+    Wakes up the progress views once the task has finished and its result
+    has been stored.
+    """
+    result_store.publish_progress(task_id)
+
+def get_answer_results(task, test_plan, student_files, force=False):
+    """
+    Returns the test results of an answer, their JSON and the fingerprint of
+    the answer (None if answers to the exercise can't be deduplicated).
+    Unless force is set, the results of an identical earlier answer are
+    reused.
+    """
+    exercise_id = test_plan["exercise_id"]
+    submission_fingerprint = None
+    if submission_cache.is_cacheable(test_plan):
+        submission_fingerprint = submission_cache.submission_fingerprint(test_plan, student_files)
+
+    if submission_fingerprint is not None and not force:
+        evaluation_id = submission_cache.get_evaluation_id(exercise_id, submission_fingerprint)
+        if evaluation_id is not None:
+            test_results = courses.models.Evaluation.objects.filter(id=evaluation_id)\
+                .values_list("test_results", flat=True).first()
+            if test_results:
+                print("Reusing the results of evaluation %d" % evaluation_id)
+                return json.loads(test_results), test_results, submission_fingerprint
+
+    results = run_all_tests(task, test_plan, student_files)
+    return results, json.dumps(results), submission_fingerprint
+
+def run_all_tests(task, test_plan, student_files):
+    """
+    Runs all the tests of the test plan for both the student's files and the
+    reference files, reusing the cached reference results where possible.
+    Returns the results as {"student": ..., "reference": ...}. The progress is
+    reported to the given task, if any.
+
+    Tests whose outputs are all checked against expected outputs aren't run
+    with the reference files; their reference results are None.
+    """
+    exercise_id = test_plan["exercise_id"]
+    tests = test_plan["tests"]
+    tests_by_id = {test["id"]: test for test in tests}
+    roots, snapshot_stages = get_stage_dependencies(tests)
+    cache_reference = reference_cache.is_cacheable(test_plan)
+
+    reference_files = {f["name"]: file_cache.read_file(f["path"])
+                       for f in test_plan["files"]
+                       if f["purpose"] == "REFERENCE"}
+
+    # Run the input generators once, so that both runs of a test get the
+    # same inputs
+    inputs = generate_test_inputs(test_plan)
+
+    student_results = {}
+    reference_results = {test["id"]: None for test in tests
+                         if not expected_output.needs_reference(test)}
+
+    jobs = [(test["id"], True) for test in tests]
+    fingerprints = {}
+    if cache_reference:
+        # A test started from another test's snapshot depends on the
+        # configuration of that test as well
+        def fingerprint(test_id, visiting=()):
+            if test_id not in fingerprints:
+                parent_fingerprint = None
+                if test_id in roots:
+                    parent_id = snapshot_stages[roots[test_id]]
+                    if parent_id not in visiting:
+                        parent_fingerprint = fingerprint(parent_id, visiting + (test_id,))
+                fingerprints[test_id] = reference_cache.test_fingerprint(
+                    tests_by_id[test_id], test_plan["files"], parent_fingerprint,
+                    inputs[test_id]["seed"] if test_id in inputs else None
+                )
+            return fingerprints[test_id]
+
+        # Reuse the cached reference results of unchanged tests, but run the
+        # tests other uncached tests start from to get their snapshots
+        uncached = set()
+        for test in tests:
+            if test["id"] in reference_results:
+                continue
+            cached_results = reference_cache.get_results(exercise_id, fingerprint(test["id"]))
+            if cached_results is None:
+                uncached.add(test["id"])
+            else:
+                reference_results.update(cached_results)
+        reference_jobs = set()
+        for test_id in uncached:
+            while test_id not in reference_jobs:
+                reference_jobs.add(test_id)
+                if test_id not in roots:
+                    break
+                test_id = snapshot_stages[roots[test_id]]
+        jobs.extend((test["id"], False) for test in tests if test["id"] in reference_jobs)
+    else:
+        reference_jobs = set()
+        for test in tests:
+            test_id = test["id"]
+            if test_id in reference_results:
+                continue
+            while test_id not in reference_jobs:
+                reference_jobs.add(test_id)
+                if test_id not in roots:
+                    break
+                test_id = snapshot_stages[roots[test_id]]
+        jobs.extend((test["id"], False) for test in tests if test["id"] in reference_jobs)
+
+    # Run all the tests for both the returned and reference code in parallel.
+    # Each test is evaluated as soon as both of its runs are done, and the
+    # evaluated tests are published with the progress.
+    evaluated_tests = []
+    pending_runs = collections.Counter(test_id for test_id, student in jobs)
+    cancelled = threading.Event()
+    with tempfile.TemporaryDirectory(dir=workspace.get_root()) as snapshot_root:
+        file_sets = {True: student_files, False: reference_files}
+        test_runs = run_test_graph(jobs, roots, snapshot_stages, test_plan,
+                                   file_sets, snapshot_root, cancelled, inputs)
+        for i, (test_id, student, results) in enumerate(test_runs):
+            pending_runs[test_id] -= 1
+            if results[test_id].get("skipped"):
+                continue
+            if student:
+                student_results.update(results)
+            else:
+                reference_results.update(results)
+                # Results without inputs to run on aren't worth keeping
+                if test_id in fingerprints and (test_id not in inputs or inputs[test_id]["ok"]):
+                    reference_cache.set_results(exercise_id, fingerprints[test_id], results)
+            if not pending_runs[test_id] and test_id in student_results \
+                    and test_id in reference_results:
+                output_files.compare(
+                    student_results[test_id], reference_results[test_id],
+                    get_expected_output_paths(tests_by_id[test_id], test_plan["files"]),
+                    get_capture_dir(snapshot_root, test_id, True),
+                    get_capture_dir(snapshot_root, test_id, False),
+                )
+                evaluated_test = generate_test_result(
+                    test_id, student_results[test_id], reference_results[test_id]
+                )
+                evaluated_tests.append(evaluated_test)
+                if test_plan["fail_fast"] and not evaluated_test["correct"]:
+                    # No need to run the rest of the tests
+                    cancelled.set()
+            if task is not None:
+                task.update_state(state="PROGRESS", meta={"current": i + 1, "total": len(jobs),
+                                                          "tests": evaluated_tests})
+                result_store.publish_progress(task.request.id)
+
+    # Mark the tests that weren't compared because of fail fast
+    if cancelled.is_set():
+        for test in tests:
+            if test["id"] not in student_results or test["id"] not in reference_results:
+                skipped = {"fail": True, "skipped": True, "name": test["name"], "stages": {}}
+                student_results[test["id"]] = skipped
+                reference_results.setdefault(test["id"], skipped)
+
+    #print(student_results.items())
+    #print(reference_results.items())
+
+    return {"student": student_results, "reference": reference_results}
+
+def get_capture_dir(snapshot_root, test_id, student):
+    """Returns the directory the output files of a test run are moved into."""
+    return os.path.join(snapshot_root, "student" if student else "reference",
+                        "output-%d" % test_id)
+
+def get_expected_output_paths(test, include_files):
+    """Returns the paths of the OUTPUT include files of a test by file name."""
+    return {f["name"]: f["path"] for f in include_files
+            if f["purpose"] == "OUTPUT" and f["id"] in test["required_files"]}
+
+def get_test_concurrency():
+    """
+    Returns the maximum number of test runs a single task executes
+    concurrently. Configurable with FILE_EXERCISE_TEST_CONCURRENCY in settings;
+    a value of 1 runs the tests sequentially.
+
+    Every pool process of the worker runs its own tests, so a machine runs up
+    to this times the worker concurrency (-c) programs at once, and the tests
+    are timed by the wall clock. By default the CPUs are divided between the
+    pool processes, which is 1 with Celery's default of a process per CPU.
+    The pool size is read from CELERYD_CONCURRENCY; with -c given on the
+    command line, set FILE_EXERCISE_TEST_CONCURRENCY to match it.
+    """
+    concurrency = getattr(settings, "FILE_EXERCISE_TEST_CONCURRENCY", None)
+    if not concurrency:
+        cpus = os.cpu_count() or 1
+        concurrency = cpus // (getattr(settings, "CELERYD_CONCURRENCY", None) or cpus)
+    return max(1, int(concurrency))
+
+def get_stage_dependencies(tests):
+    """
+    Builds the dependency graph between the tests of an exercise from the
+    depends_on relations of their stages. A test whose first stage depends on
+    a stage of another test is started from a snapshot of that test's
+    directory, taken right after the stage was run.
+
+    Returns a dict mapping the ids of the dependent tests to the ids of the
+    stages they depend on, and a dict mapping the ids of those stages to the
+    ids of the tests they belong to. The dependencies of the other stages
+    can't be honoured, and are reported and ignored (the admin rejects them).
+    """
+    stage_tests = {stage["id"]: test["id"] for test in tests for stage in test["stages"]}
+
+    roots = {}
+    for test in tests:
+        if not test["stages"]:
+            continue
+        first_stage = min(test["stages"], key=lambda stage: stage["ordinal_number"])
+        for stage in test["stages"]:
+            if stage is not first_stage and stage["depends_on"] is not None:
+                print("Ignoring the dependency of stage %d of test %d on stage %d: "
+                      "only the first stage of a test can depend on another test" % (
+                          stage["id"], test["id"], stage["depends_on"]))
+        depends_on_test = stage_tests.get(first_stage["depends_on"], test["id"])
+        if depends_on_test != test["id"]:
+            roots[test["id"]] = first_stage["depends_on"]
+    snapshot_stages = {stage_id: stage_tests[stage_id] for stage_id in roots.values()}
+    return roots, snapshot_stages
+
+def run_test_graph(jobs, roots, snapshot_stages, test_plan, file_sets, snapshot_root,
+                   cancelled=None, inputs=None):
+    """
+    Runs the given (test id, student) jobs in a thread pool and yields
+    (test id, student, results) tuples as the tests finish. A shared stage is
+    run only once per file set; the tests depending on it are started from
+    its snapshot as soon as the test containing the stage has finished, and
+    independent tests run in parallel. file_sets maps the student flag to the
+    files under test.
+
+    The actual work happens in subprocesses, so threads are enough here (and
+    Celery's daemonic prefork workers can't spawn process pools anyway).
+
+    Once the threading.Event cancelled is set, no more jobs are started and
+    the running ones stop after their current stage. inputs maps test ids to
+    the generated inputs of the tests.
+    """
+    inputs = inputs or {}
+    tests = {test["id"]: test for test in test_plan["tests"]}
+
+    def snapshot_path(stage_id, student):
+        return os.path.join(snapshot_root, "student" if student else "reference", str(stage_id))
+
+    def is_ready(job):
+        test_id, student = job
+        return test_id not in roots or (snapshot_stages[roots[test_id]], student) in finished
+
+    waiting = list(jobs)
+    finished = set()
+    futures = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=get_test_concurrency()) as executor:
+        while waiting or futures:
+            if cancelled is not None and cancelled.is_set():
+                waiting = []
+                for future in [future for future in futures if future.cancel()]:
+                    del futures[future]
+                if not futures:
+                    break
+
+            for job in [job for job in waiting if is_ready(job)]:
+                waiting.remove(job)
+                test_id, student = job
+                start_from = snapshot_path(roots[test_id], student) if test_id in roots else None
+                snapshots = {stage_id: snapshot_path(stage_id, student)
+                             for stage_id, stage_test_id in snapshot_stages.items()
+                             if stage_test_id == test_id}
+                future = executor.submit(run_test, tests[test_id], test_plan["files"],
+                                         file_sets[student], start_from, snapshots,
+                                         cancelled, inputs.get(test_id),
+                                         get_capture_dir(snapshot_root, test_id, student))
+                futures[future] = job
+
+            if not futures:
+                print("Circular stage dependencies, unable to run tests: %s" % (waiting))
+                break
+
+            done, _ = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                test_id, student = futures.pop(future)
+                finished.add((test_id, student))
+                yield test_id, student, future.result()
+
 def generate_results(results, exercise_id):
     evaluation = {}
     correct = True
@@ -158,151 +512,381 @@ def generate_results(results, exercise_id):
     test_tree = {"tests": []}
 
     #### GO THROUGH ALL TESTS
-    for test_id, student_t, reference_t in ((k, student[k], reference[k]) for k in matched):
-        current_test = {
-            "test_id": test_id,
-            "name": student_t["name"],
-            "correct": True,
-            "stages": [],
-        }
-
+    for test_id in matched:
+        current_test = generate_test_result(test_id, student[test_id], reference[test_id])
         test_tree["tests"].append(current_test)
+        if not current_test["correct"]:
+            correct = False
 
-        student_stages = student_t["stages"]
-        reference_stages = reference_t["stages"]
-
-        unmatched_stages = set(student_stages.keys()) ^ set(reference_stages.keys())
-        matched_stages = set(student_stages.keys()) & set(reference_stages.keys())
-
-        #### GO THROUGH ALL STAGES
-        for stage_id, student_s, reference_s in ((k, student_stages[k], reference_stages[k])
-                                                  for k in sorted(matched_stages,
-                                                                  key=lambda x: student_stages[x]["ordinal_number"])):
-            current_stage = {
-                "stage_id": stage_id,
-                "name": student_s["name"],
-                "ordinal_number": student_s["ordinal_number"],
-                "commands": [],
+    evaluation.update({
+        "correct": correct,
+        "test_tree": test_tree,
+    })
+    return evaluation
+
+def generate_test_result(test_id, student_t, reference_t):
+    """
+    Compares the student's and the reference results of a single test and
+    returns the evaluation of the test for the test tree. Outputs with
+    expected outputs are judged by those instead of the reference output,
+    and reference_t is None if the test wasn't run with the reference files.
+    """
+    current_test = {
+        "test_id": test_id,
+        "name": student_t["name"],
+        "correct": True,
+        "seed": student_t.get("seed"),
+        "stages": [],
+    }
+
+    # The test wasn't run, because an earlier test failed in fail fast mode
+    if student_t.get("skipped"):
+        current_test["correct"] = False
+        current_test["skipped"] = True
+        return current_test
+
+    # The test couldn't be run, because its input generator failed
+    if student_t.get("input_error") is not None:
+        current_test["correct"] = False
+        current_test["input_error"] = student_t["input_error"]
+        return current_test
+
+    # The student's test was aborted (e.g. the stage it depends on failed)
+    if student_t["fail"] and (reference_t is None or not reference_t["fail"]):
+        current_test["correct"] = False
+
+    student_stages = student_t["stages"]
+    reference_stages = reference_t["stages"] if reference_t is not None else student_stages
+
+    unmatched_stages = set(student_stages.keys()) ^ set(reference_stages.keys())
+    matched_stages = set(student_stages.keys()) & set(reference_stages.keys())
+
+    #### GO THROUGH ALL STAGES
+    for stage_id, student_s, reference_s in ((k, student_stages[k], reference_stages[k])
+                                              for k in sorted(matched_stages,
+                                                              key=lambda x: student_stages[x]["ordinal_number"])):
+        current_stage = {
+            "stage_id": stage_id,
+            "name": student_s["name"],
+            "ordinal_number": student_s["ordinal_number"],
+            "commands": [],
+        }
+        current_test["stages"].append(current_stage)
+
+        student_cmds = student_s["commands"]
+        reference_cmds = reference_s["commands"] if reference_t is not None else {}
+
+        #### GO THROUGH ALL COMMANDS
+        # The commands after a failed one weren't run
+        for cmd_id, student_c, reference_c in ((k, student_cmds[k], reference_cmds.get(k))
+                                                for k in sorted(student_cmds.keys(),
+                                                                key=lambda x: student_cmds[x]["ordinal_number"])):
+            cmd_correct = True
+            current_cmd = {
+                "cmd_id": cmd_id,
             }
-            current_test["stages"].append(current_stage)
+            # The outputs are only needed for the diffs, which are read
+            # from the test results
+            current_cmd.update((k, v) for k, v in student_c.items()
+                               if k not in ("stdout", "stderr"))
+            current_stage["commands"].append(current_cmd)
+
+            # A command that exits with an unexpected return value fails
+            if student_c["expected_retval"] is not None \
+                    and student_c["retval"] != student_c["expected_retval"]:
+                cmd_correct = False
+
+            # Handle stdout and stderr. Only the verdict is determined
+            # here, the diffs are rendered on demand by render_output_diff.
+
+            hints = []
+            for stream in ("stdout", "stderr"):
+                student_output = student_c[stream]
+                output_check = student_c.get("expected_" + stream)
+                if output_check is not None:
+                    # Checked against the expected outputs instead
+                    if not output_check["correct"]:
+                        cmd_correct = False
+                    hints.extend(output_check["hints"])
+                    current_cmd[stream + "_differs"] = False
+                    current_cmd[stream + "_matches"] = output_check["correct"]
+                    current_cmd["has_" + stream] = bool(student_output)
+                    continue
+
+                reference_output = reference_c[stream] if reference_c is not None else ""
+                differs = not comparison.outputs_match(
+                    student_output, reference_output,
+                    student_c.get("comparison_mode"), student_c.get("numeric_tolerance", 0.0)
+                )
+
+                if student_c["significant_" + stream] and differs:
+                    cmd_correct = False
 
-            student_cmds = student_s["commands"]
-            reference_cmds = reference_s["commands"]
+                current_cmd[stream + "_differs"] = differs
+                current_cmd["has_" + stream] = bool(student_output or reference_output)
+            current_cmd["hints"] = hints
 
-            #### GO THROUGH ALL COMMANDS
-            for cmd_id, student_c, reference_c in ((k, student_cmds[k], reference_cmds[k])
-                                                    for k in sorted(reference_cmds.keys(),
-                                                                    key=lambda x: student_cmds[x]["ordinal_number"])):
-                cmd_correct = True
-                current_cmd = {
-                    "cmd_id": cmd_id,
-                }
-                current_cmd.update(student_c)
-                current_stage["commands"].append(current_cmd)
+            if not cmd_correct:
+                current_test["correct"] = False
 
-                # Handle stdin
+    #### GO THROUGH ALL OUTPUT FILES
+    current_test["output_files"] = []
+    for name, student_f in sorted((student_t.get("output_files") or {}).items()):
+        if student_f is None or "matches" not in student_f:
+            continue
+        if not student_f["matches"]:
+            current_test["correct"] = False
+        current_test["output_files"].append(dict(student_f, name=name))
 
-                current_cmd["input_text"] = current_cmd["input_text"]
+    return current_test
 
-                # Handle stdout
+OUTPUT_DIFF_DESCRIPTIONS = {
+    "stdout": ("Your program's output", "Expected output"),
+    "stderr": ("Your program's errors", "Expected errors"),
+}
 
-                student_stdout = student_c["stdout"]
-                reference_stdout = reference_c["stdout"]
+def use_patience_diff():
+    """
+    Tells whether the output diffs are made with the patience differ.
+    FILE_EXERCISE_DIFF_BACKEND in settings selects between "patience" (the
+    default, linear time on outputs that differ on every line) and "difflib".
+    """
+    return getattr(settings, "FILE_EXERCISE_DIFF_BACKEND", "patience") != "difflib"
 
-                if student_c["significant_stdout"] and student_stdout != reference_stdout:
-                    cmd_correct = False
-                
-                if student_stdout or reference_stdout:
-                    stdout_diff = difflib.HtmlDiff().make_table(
-                        fromlines=student_stdout.splitlines(), tolines=reference_stdout.splitlines(),
-                        fromdesc="Your program's output", todesc="Expected output"
-                    )
-                else:
-                    stdout_diff = ""
-                current_cmd["stdout_diff"] = stdout_diff
-
-                # Handle stderr
-
-                student_stderr = student_c["stderr"]
-                reference_stderr = reference_c["stderr"]
-
-                if student_c["significant_stderr"] and student_stderr != reference_stderr:
-                    cmd_correct = False
+def get_output_differ(key=None):
+    """
+    Returns the differ used for the output diffs, matching the lines by key
+    if given and checking the replaced lines again with the comparison rule
+    of the key (see comparison.NumericKey). The intraline highlighting budget of the patience differ is set
+    with FILE_EXERCISE_DIFF_INTRALINE_MAX_LINES and
+    FILE_EXERCISE_DIFF_INTRALINE_MAX_LENGTH.
+    """
+    if not use_patience_diff():
+        return None
+    return linediff.PatienceDiffer(
+        intraline_max_lines=getattr(settings, "FILE_EXERCISE_DIFF_INTRALINE_MAX_LINES", 100),
+        intraline_max_length=getattr(settings, "FILE_EXERCISE_DIFF_INTRALINE_MAX_LENGTH", 1000),
+        key=key,
+        linematch=comparison.diff_linematch(key),
+    )
 
-                if student_stderr or reference_stderr:
-                    stderr_diff = difflib.HtmlDiff().make_table(
-                        fromlines=student_stderr.splitlines(), tolines=reference_stderr.splitlines(),
-                        fromdesc="Your program's errors", todesc="Expected errors"
-                    )
-                else:
-                    stderr_diff = ""
-                current_cmd["stderr_diff"] = stderr_diff
+_diff_cache = None
+_diff_cache_lock = threading.Lock()
 
-                current_test["correct"] = cmd_correct if current_test["correct"] else False
-                if cmd_correct == False: correct = False
+def get_diff_cache():
+    """
+    Returns the diff cache of this process. It keeps the most recently used
+    diffs in memory up to FILE_EXERCISE_DIFF_CACHE_SIZE bytes (32 MiB by
+    default) and shares them through the reference result cache backend for
+    FILE_EXERCISE_DIFF_CACHE_TIMEOUT seconds (a day by default).
+    """
+    global _diff_cache
+    with _diff_cache_lock:
+        if _diff_cache is None:
+            _diff_cache = diffcache.DiffCache(
+                max_size=getattr(settings, "FILE_EXERCISE_DIFF_CACHE_SIZE", 32 * 1024 * 1024),
+                backend=reference_cache.get_cache(),
+                timeout=getattr(settings, "FILE_EXERCISE_DIFF_CACHE_TIMEOUT", 24 * 60 * 60),
+                prefix="output-diff",
+            )
+        return _diff_cache
+
+def render_output_diff(stream, student_output, reference_output, offset=0,
+                       mode=comparison.EXACT, tolerance=0.0, cache=None):
+    """
+    Returns one page of the HTML diff table between the student's and the
+    reference output of a command, starting from the hunk at offset, and the
+    offset of the next page (None on the last page). Unchanged lines are
+    folded and each page has FILE_EXERCISE_DIFF_HUNKS_PER_PAGE hunks (10 by
+    default). The pages are memoized by the hashes of the outputs in cache,
+    or in the cache of get_diff_cache if not given.
+
+    The outputs are normalized for the comparison mode of the command, so
+    the differences it ignores aren't shown.
+    """
+    hunks = getattr(settings, "FILE_EXERCISE_DIFF_HUNKS_PER_PAGE", 10)
+    # Only the first page has the column headers
+    fromdesc, todesc = OUTPUT_DIFF_DESCRIPTIONS[stream] if offset == 0 else ("", "")
+
+    student_lines = comparison.diff_lines(student_output, mode)
+    reference_lines = comparison.diff_lines(reference_output, mode)
+    key = comparison.diff_key(mode, tolerance)
+    if key is not None and not use_patience_diff():
+        # difflib can't match by key, so show the normalized lines. Numbers
+        # rounded to different sides of a bucket are shown as changed.
+        student_lines = [key(line) for line in student_lines]
+        reference_lines = [key(line) for line in reference_lines]
+        key = None
+
+    cache = cache or get_diff_cache()
+    return diffcache.CachedHtmlDiff(differ=get_output_differ(key), cache=cache).make_table_page(
+        fromlines=student_lines, tolines=reference_lines,
+        fromdesc=fromdesc, todesc=todesc, offset=offset, hunks=hunks
+    )
 
-                
+def generate_test_inputs(test_plan):
+    """
+    Runs the input generator of each test that requires one (the first one,
+    if there are several) and returns the generated inputs keyed by test id.
 
-    evaluation.update({
-        "correct": correct,
-        "test_tree": test_tree,
-    })
-    return evaluation
+    Each test gets a seed picked at random from FILE_EXERCISE_INPUTGEN_SEEDS
+    seeds (100 by default). The smaller the pool, the more often the inputs
+    and the reference results of a seed can be reused from the cache, but the
+    fewer different inputs the students see.
+    """
+    generators = {f["id"]: f for f in test_plan["files"] if f["purpose"] == "INPUTGEN"}
+    seed_count = getattr(settings, "FILE_EXERCISE_INPUTGEN_SEEDS", 100)
+    rng = random.SystemRandom()
+
+    inputs = {}
+    for test in test_plan["tests"]:
+        test_generators = [generators[file_id] for file_id in test["required_files"]
+                           if file_id in generators]
+        if test_generators:
+            inputs[test["id"]] = get_generated_inputs(test_generators[0], rng.randrange(seed_count))
+    return inputs
+
+def get_generated_inputs(generator, seed):
+    """
+    Returns the inputs generated by the given input generator with the seed.
+    A generator is expected to give the same inputs for the same seed, so the
+    inputs are cached like the reference results.
+    """
+    contents = file_cache.read_file(generator["path"])
+    h = hashlib.sha256(generator["name"].encode("utf-8"))
+    h.update(contents)
+    key = "generated-inputs:%s:%d" % (h.hexdigest(), seed)
+
+    cache = reference_cache.get_cache()
+    inputs = cache.get(key)
+    if inputs is None:
+        inputs = run_input_generator(generator["name"], contents, seed)
+        if inputs["ok"]:
+            cache.set(key, inputs, getattr(settings, "FILE_EXERCISE_REFERENCE_CACHE_TIMEOUT", None))
+    return inputs
+
+def run_input_generator(name, contents, seed):
+    """
+    Runs an input generator as "./<name> <seed>" in an empty directory. The
+    files it creates there become input files of the test; the contents of a
+    file named .argv replace $GENERATED_ARGS in the command lines; and its
+    output is given as the standard input to the commands that have no
+    input of their own. If the generator fails, ok is False and error has
+    its standard error.
+    """
+    command = {
+        "command_line": "./%s %d" % (shlex.quote(name), seed),
+        "timeout": getattr(settings, "FILE_EXERCISE_INPUTGEN_TIMEOUT", 10),
+        "ordinal_number": 0,
+        "return_value": 0,
+        "input_text": "",
+        "significant_stdout": False,
+        "significant_stderr": False,
+    }
+    with tempfile.TemporaryDirectory(dir=workspace.get_root()) as gen_dir:
+        path = os.path.join(gen_dir, name)
+        with open(path, "wb") as fd:
+            fd.write(contents)
+        os.chmod(path, 0o755)
+
+        stdout = io.BytesIO()
+        stderr = io.BytesIO()
+        with tempfile.TemporaryFile(dir=gen_dir) as stdin:
+            proc_results = run_command(command, stdin, stdout, stderr, gen_dir, [])
+        os.remove(path)
+
+        ok = proc_results["retval"] == 0
+        error = decode_output(stderr.getvalue())[0]
+        if not ok:
+            print("Input generator %s failed with seed %d: %s" % (name, seed, error))
+
+        files = {}
+        args = []
+        for file_name in os.listdir(gen_dir):
+            file_path = os.path.join(gen_dir, file_name)
+            if not os.path.isfile(file_path):
+                continue
+            with open(file_path, "rb") as fd:
+                data = fd.read()
+            if file_name == ".argv":
+                args = shlex.split(data.decode("utf-8"))
+            else:
+                files[file_name] = data
+
+    return {
+        "seed": seed,
+        "ok": ok,
+        "error": error,
+        "files": files,
+        "args": args,
+        "stdin": decode_output(stdout.getvalue())[0],
+    }
 
-@shared_task(name="courses.run-test", bind=True, serializer='json')
-def run_test(self, test_id, answer_id, exercise_id, student=False):
+def apply_generated_inputs(stages, inputs):
     """
-    Runs all the stages of the given test.
+    Returns a copy of the stages of a test with the generated arguments and
+    standard input applied to the commands.
     """
-    try:
-        test = courses.models.FileExerciseTest.objects.get(id=test_id)
-    except courses.models.FileExerciseTest.DoesNotExist as e:
-        # TODO: Log weird request
-        return # TODO: Find a way to signal the failure to the user
+    args = " ".join(shlex.quote(arg) for arg in inputs["args"])
+    return [
+        dict(stage, commands=[
+            dict(cmd,
+                 command_line=cmd["command_line"].replace("$GENERATED_ARGS", args),
+                 input_text=cmd["input_text"] or inputs["stdin"])
+            for cmd in stage["commands"]
+        ])
+        for stage in stages
+    ]
 
-    try:
-        stages = courses.models.FileExerciseTestStage.objects.filter(test=test_id)
-    except courses.models.FileExerciseTestStage.DoesNotExist as e:
-        # TODO: Log weird request
-        return # TODO: Find a way to signal the failure to the user
+@shared_task(name="courses.run-test", bind=True, serializer='json')
+def run_test(self, test, include_files, files_to_check, start_from=None,
+             snapshots=None, cancelled=None, inputs=None, capture_dir=None):
+    """
+    Runs all the stages of the given test from the test plan, using the files
+    under test given in files_to_check.
 
-    try:
-        exercise_file_objects = courses.models.FileExerciseTestIncludeFile.objects.filter(exercise=exercise_id)
-    except courses.models.FileExerciseTestIncludeFile.DoesNotExist as e:
-        # TODO: Log weird request
-        return # TODO: Find a way to signal the failure to the user
+    If start_from is given, the test directory is initialized with a copy of
+    that stage snapshot. The directory is copied into the paths in snapshots
+    (a dict keyed by stage id) after the corresponding stages have been run.
 
-    # Note: requires a shared/cloned file system!
-    if student:
-        try:
-            answer_object = courses.models.UserFileUploadExerciseAnswer.objects.get(id=answer_id)
-        except courses.models.UserFileUploadExerciseAnswer.DoesNotExist as e:
-            # TODO: Log weird request
-            return # TODO: Find a way to signal the failure to the user
-        
-        files_to_check = answer_object.get_returned_files_raw()
-        print("".join("%s:\n%s" % (n, c) for n, c in files_to_check.items()))
-    else:
-        files_to_check = {f.name: f.get_file_contents()
-                          for f in exercise_file_objects
-                          if f.purpose == "REFERENCE"}
-        print("".join("%s:\n%s" % (n, c) for n, c in files_to_check.items()))
-
-    # TODO: Replace with the directory of the ramdisk
-    temp_dir_prefix = os.path.join("/", "tmp")
-
-    test_results = {test_id: {"fail": True, "name": test.name, "stages": {}}}
-    with tempfile.TemporaryDirectory(dir=temp_dir_prefix) as test_dir:
-        # Write the files required by this test
-        for name, contents in ((f.name, f.get_file_contents())
-                               for f in exercise_file_objects
-                               if f in test.required_files.all() and
-                               f.purpose in ("INPUT", "WRAPPER", "TEST")):
-            fpath = os.path.join(test_dir, name)
-            with open(fpath, "wb") as fd:
+    If the threading.Event cancelled is set while the test is running, the
+    remaining stages are skipped and the results are marked skipped.
+
+    inputs are the inputs generated for the test by generate_test_inputs. If
+    the generator failed, the test isn't run and fails with its error.
+
+    The files named by the test's OUTPUT include files are moved into
+    capture_dir, if given, once the test has been run.
+    """
+    test_id = test["id"]
+    temp_dir_prefix = workspace.get_root()
+
+    test_results = {test_id: {"fail": True, "name": test["name"], "stages": {}}}
+    stages = test["stages"]
+    if inputs is not None:
+        stages = apply_generated_inputs(stages, inputs)
+        test_results[test_id]["seed"] = inputs["seed"]
+        if not inputs["ok"]:
+            test_results[test_id]["input_error"] = inputs["error"]
+            return test_results
+
+    if start_from is not None and not os.path.isdir(start_from):
+        # The stage this test depends on failed or was never reached
+        return test_results
+
+    # The files required by this test are written into a template once and
+    # cloned for each run
+    template = workspace.get_template(test_id, [
+        f for f in include_files
+        if f["id"] in test["required_files"] and f["purpose"] in ("INPUT", "WRAPPER", "TEST")
+    ])
+    sources = (start_from, template) if start_from is not None else (template,)
+
+    with workspace.test_workspace(*sources) as test_dir:
+        # Write the generated input files
+        for name, contents in (inputs["files"].items() if inputs else ()):
+            with open(os.path.join(test_dir, name), "wb") as fd:
                 fd.write(contents)
-            print("Wrote required test file %s" % (fpath))
-            # TODO: chmod, chown, chgrp
 
         # Write the files under test
         for name, contents in files_to_check.items():
@@ -316,43 +900,42 @@ def run_test(self, test_id, answer_id, exercise_id, student=False):
         for i, stage in enumerate(stages):
             #self.update_state(state="PROGRESS",
                               #meta={"current": i, "total": len(stages)})
-            
-            stage_results = run_stage(stage.id, test_dir, temp_dir_prefix,
+            if cancelled is not None and cancelled.is_set():
+                test_results[test_id]["skipped"] = True
+                break
+
+            stage_results = run_stage(stage, test_dir, temp_dir_prefix,
                                       list(files_to_check.keys()))
-            test_results[test_id]["stages"][stage.id] = stage_results
-            test_results[test_id]["stages"][stage.id]["name"] = stage.name
-            test_results[test_id]["stages"][stage.id]["ordinal_number"] = stage.ordinal_number
+            test_results[test_id]["stages"][stage["id"]] = stage_results
+            test_results[test_id]["stages"][stage["id"]]["name"] = stage["name"]
+            test_results[test_id]["stages"][stage["id"]]["ordinal_number"] = stage["ordinal_number"]
 
             if stage_results["fail"] == True:
                 break
 
-            # TODO: Read the directory and save the stage results in cache
-            cache_results = False # TODO: Determine this by looking at dependencies
-            if cache_results == True:
-                test_dir_contents = os.listdir(test_dir)
-                for fp in test_dir_contents:
-                    with open(fp, "rb") as fd:
-                        contents = fd.read()
+            # Save the directory for the tests that depend on this stage
+            if snapshots and stage["id"] in snapshots:
+                shutil.copytree(test_dir, snapshots[stage["id"]], symlinks=True)
         else:
             test_results[test_id]["fail"] = False
 
-        # TODO: Read the expected output files (check the cache first?)
-        test_dir_contents = os.listdir(test_dir)
+        # Keep the generated files for comparing them to the expected ones
+        output_names = get_expected_output_paths(test, include_files).keys()
+        if capture_dir is not None and output_names:
+            test_results[test_id]["output_files"] = output_files.capture(
+                test_dir, output_names, capture_dir
+            )
 
     return test_results
 
 @shared_task(name="courses.run-stage", bind=True, serializer='json')
-def run_stage(self, stage_id, test_dir, temp_dir_prefix, files_to_check):
+def run_stage(self, stage, test_dir, temp_dir_prefix, files_to_check):
     """
     Runs all the commands of this stage and collects the return values and the
-    outputs.
+    outputs. The stage fails and the rest of its commands are skipped when a
+    command doesn't exit with its expected return value.
     """
-
-    try:
-        commands = courses.models.FileExerciseTestCommand.objects.filter(stage=stage_id)
-    except courses.models.FileExerciseTestCommand.DoesNotExist as e:
-        # TODO: Log weird request
-        return # TODO: Find a way to signal the failure to the user
+    commands = stage["commands"]
 
     stage_results = {
         "fail": False,
@@ -366,8 +949,7 @@ def run_stage(self, stage_id, test_dir, temp_dir_prefix, files_to_check):
     """
     cmd_chain = chain(
         run_command_chainable.s(
-            {"id":cmd.id, "input_text":cmd.input_text, "return_value":cmd.return_value},
-            temp_dir_prefix, test_dir, files_to_check
+            cmd, temp_dir_prefix, test_dir, files_to_check
         )
         for cmd in commands
     )
@@ -381,11 +963,11 @@ def run_stage(self, stage_id, test_dir, temp_dir_prefix, files_to_check):
     """
     # DEBUG #
     for i, cmd in enumerate(commands):
-        results = run_command_chainable(
-            {"id":cmd.id, "input_text":cmd.input_text, "return_value":cmd.return_value},
-            temp_dir_prefix, test_dir, files_to_check
+        stage_results = run_command_chainable(
+            cmd, temp_dir_prefix, test_dir, files_to_check, stage_results
         )
-        stage_results.update(results)
+        if stage_results["fail"]:
+            break
 
     # DEBUG #
 
@@ -462,70 +1044,191 @@ def cp437_decoder(input_bytes):
     return "\n".join(byt_ln.decode('ibm437').translate(tr_table)
                      for byt_ln in input_bytes.split(CRLF))
 
+def decode_output(output, truncated=False):
+    """
+    Decodes the output of a command. Returns the text and whether the output
+    was binary, in which case it is shown as code page 437.
+    """
+    try:
+        return output.decode("utf-8"), False
+    except UnicodeDecodeError as e:
+        # Truncation may have split the last character
+        if truncated and e.reason == "unexpected end of data":
+            try:
+                return output[:e.start].decode("utf-8"), False
+            except UnicodeDecodeError:
+                pass
+        return cp437_decoder(output), True
+
 @shared_task(name="courses.run-command-chain-block", serializer='json')
 def run_command_chainable(cmd, temp_dir_prefix, test_dir, files_to_check, stage_results=None):
     cmd_id, cmd_input_text, cmd_return_value = cmd["id"], cmd["input_text"], cmd["return_value"]
     if stage_results is None or "commands" not in stage_results.keys():
-        stage_results = {"commands": {}}
+        stage_results = {"fail": False, "commands": {}}
 
-    stdout = tempfile.TemporaryFile(dir=temp_dir_prefix)
-    stderr = tempfile.TemporaryFile(dir=temp_dir_prefix)
+    stdout = io.BytesIO()
+    stderr = io.BytesIO()
     stdin = tempfile.TemporaryFile(dir=temp_dir_prefix)
     stdin.write(bytearray(cmd_input_text, "utf-8"))
     stdin.seek(0)
     
-    proc_results = run_command(cmd_id, stdin, stdout, stderr, test_dir, files_to_check)
-    
-    stdout.seek(0)
-    #proc_results["stdout"] = base64.standard_b64encode(stdout.read()).decode("ASCII")
-    read_stdout = stdout.read()
-    try:
-        proc_results["stdout"] = read_stdout.decode("utf-8")
-        proc_results["binary_stdout"] = False
-    except UnicodeDecodeError as e:
-        proc_results["stdout"] = cp437_decoder(read_stdout)
-        proc_results["binary_stdout"] = True
-    stdout.close()
+    proc_results = run_command(cmd, stdin, stdout, stderr, test_dir, files_to_check)
+    stdin.close()
 
-    stderr.seek(0)
-    #proc_results["stderr"] = base64.standard_b64encode(stderr.read()).decode("ASCII")
-    read_stderr = stderr.read()
-    try:
-        proc_results["stderr"] = read_stderr.decode("utf-8")
-        proc_results["binary_stderr"] = False
-    except UnicodeDecodeError as e:
-        proc_results["stderr"] = cp437_decoder(read_stderr)
-        proc_results["binary_stderr"] = True
-    stderr.close()
+    for name, output in (("stdout", stdout), ("stderr", stderr)):
+        proc_results[name], proc_results["binary_" + name] = decode_output(
+            output.getvalue(), proc_results["truncated"]
+        )
+        output.close()
+        proc_results["expected_" + name] = expected_output.check(cmd, name, proc_results[name])
+    proc_results["comparison_mode"] = cmd.get("comparison_mode", comparison.EXACT)
+    proc_results["numeric_tolerance"] = cmd.get("numeric_tolerance", 0.0)
 
     # TODO: Use ordinal number istead of id?
     stage_results["commands"][cmd_id] = proc_results
 
-    #if cmd_return_value is not None and cmd_return_value != proc_results["retval"]:
-        #raise Exception()
+    # If the command failed, abort the stage
+    if cmd_return_value is not None and cmd_return_value != proc_results["retval"]:
+        stage_results["fail"] = True
 
     return stage_results
 
-@shared_task(name="courses.run-command", serializer='json')
-def run_command(cmd_id, stdin, stdout, stderr, test_dir, files_to_check):
+# Seconds to wait after SIGTERM before the process group of a timed out
+# command is killed with SIGKILL.
+TERMINATE_GRACE_PERIOD = 0.5
+
+def get_resource_limits(timeout):
     """
-    Runs the current command of this stage by automated fork & exec.
+    Returns the resource limits for running a command as (resource, value)
+    pairs. The limits are set in settings with FILE_EXERCISE_RESOURCE_LIMITS,
+    e.g. {"cpu": 10, "as": 512 * 1024 ** 2, "nproc": 64, "fsize": 16 * 1024 ** 2}.
+    Unless set otherwise, the CPU time is limited to one second over the
+    timeout of the command. Note that RLIMIT_NPROC counts all the processes of
+    the user running the worker.
     """
+    limits = {"cpu": int(math.ceil(timeout)) + 1}
+    limits.update(getattr(settings, "FILE_EXERCISE_RESOURCE_LIMITS", {}))
+    return [(getattr(resource, "RLIMIT_" + name.upper()), value)
+            for name, value in limits.items() if value is not None]
+
+def limit_resources(limits):
+    """
+    Returns a function for preexec_fn that applies the given resource limits
+    in the child process. It must not take any locks, since the worker runs
+    the commands from several threads.
+    """
+    def preexec():
+        for rlimit, value in limits:
+            resource.setrlimit(rlimit, (value, value))
+    return preexec
+
+def kill_process_group(proc, sig):
     try:
-        command = courses.models.FileExerciseTestCommand.objects.get(id=cmd_id)
-    except courses.models.FileExerciseTestCommand.DoesNotExist as e:
-        # TODO: Log weird request
-        return # TODO: Find a way to signal the failure to the user
+        os.killpg(proc.pid, sig)
+    except (ProcessLookupError, PermissionError):
+        pass
 
-    to_secs = lambda hour, minute, second, µsecond: ((hour * 60 + minute) * 60)\
-              + second + (µsecond * 0.000001)
+def reap(proc, options=0):
+    """
+    Reaps the process with wait4 and returns its resource usage, or None if
+    the process is still running and os.WNOHANG was given. RUSAGE_CHILDREN
+    can't be used, since the other threads of the worker may be running
+    commands at the same time.
+    """
+    pid, status, rusage = os.wait4(proc.pid, options)
+    if pid != proc.pid:
+        return None
+    if os.WIFSIGNALED(status):
+        proc.returncode = -os.WTERMSIG(status)
+    else:
+        proc.returncode = os.WEXITSTATUS(status)
+    return rusage
+
+def wait_with_rusage(proc, timeout=None):
+    """
+    Waits for the process to exit and returns its resource usage. Raises
+    subprocess.TimeoutExpired if the process is still running after timeout
+    seconds.
+    """
+    if timeout is None:
+        return reap(proc)
+    deadline = time.time() + timeout
+    delay = 0.0005
+    while True:
+        rusage = reap(proc, os.WNOHANG)
+        if rusage is not None:
+            return rusage
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise subprocess.TimeoutExpired(proc.args, timeout)
+        delay = min(delay * 2, remaining, 0.05)
+        time.sleep(delay)
+
+def get_output_limit():
+    """
+    Returns the maximum number of bytes captured from each output stream of
+    a command, set with FILE_EXERCISE_OUTPUT_LIMIT in settings.
+    """
+    return getattr(settings, "FILE_EXERCISE_OUTPUT_LIMIT", 1024 * 1024)
+
+def capture_output(proc, outputs, limit, deadline):
+    """
+    Copies at most limit bytes from each output pipe of the process into the
+    file object given for it in outputs, until the pipes are closed, the
+    process exits, the deadline passes or a stream exceeds the limit.
+
+    Returns the resource usage of the process if it has exited (None
+    otherwise) and whether any of the output was truncated.
+    """
+    selector = selectors.DefaultSelector()
+    room = {}
+    for pipe, output in outputs.items():
+        selector.register(pipe, selectors.EVENT_READ, output)
+        room[pipe] = limit
+
+    rusage = None
+    truncated = False
+    try:
+        while selector.get_map() and not truncated:
+            if rusage is None:
+                rusage = reap(proc, os.WNOHANG)
+            # Once the process has exited, only read what's already in the
+            # pipes; its children may keep them open
+            timeout = 0 if rusage is not None else min(deadline - time.time(), 0.05)
+            if timeout < 0:
+                break
+            events = selector.select(timeout)
+            if not events and rusage is not None:
+                break
+            for key, _ in events:
+                data = os.read(key.fd, 65536)
+                if not data:
+                    selector.unregister(key.fileobj)
+                    continue
+                key.data.write(data[:room[key.fileobj]])
+                if len(data) > room[key.fileobj]:
+                    truncated = True
+                room[key.fileobj] = max(room[key.fileobj] - len(data), 0)
+    finally:
+        selector.close()
+
+    return rusage, truncated
+
+@shared_task(name="courses.run-command", serializer='json')
+def run_command(command, stdin, stdout, stderr, test_dir, files_to_check):
+    """
+    Runs the current command of this stage by automated fork & exec.
 
-    cmd = command.command_line.replace(
+    The command is run in a new session, i.e. in a process group of its own,
+    so that all the processes it forks can be killed at once. Its output is
+    read through pipes into the stdout and stderr file objects; a command
+    whose output exceeds the output limit is killed and its output truncated.
+    """
+    cmd = command["command_line"].replace(
         "$RETURNABLES",
         " ".join(shlex.quote(f) for f in files_to_check)
     )
-    timeout = to_secs(command.timeout.hour, command.timeout.minute,
-                      command.timeout.second, command.timeout.microsecond)
+    timeout = command["timeout"]
     env = {"PWD": test_dir, "LC_CTYPE": "en_US.UTF-8"}
     args = shlex.split(cmd)
 
@@ -534,8 +1237,10 @@ def run_command(cmd_id, stdin, stdout, stderr, test_dir, files_to_check):
 
     start_time = time.time()
     proc = subprocess.Popen(args=args, bufsize=-1, executable=None,
-                            stdin=stdin, stdout=stdout, stderr=stderr, # Standard fds
-                            #preexec_fn=demote_process,                 # Demote before fork
+                            stdin=stdin,                               # Standard fds
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            preexec_fn=limit_resources(get_resource_limits(timeout)),
+                            start_new_session=True,                    # Own process group
                             close_fds=True,                            # Don't inherit fds
                             shell=False,                               # Don't run in shell
                             cwd=env["PWD"], env=env,
@@ -544,37 +1249,55 @@ def run_command(cmd_id, stdin, stdout, stderr, test_dir, files_to_check):
     proc_retval = None
     proc_timedout = False
     proc_killed = False
-    
+
     try:
-        proc.wait(timeout=timeout)
-        proc_runtime = time.time() - start_time
-        proc_retval = proc.returncode
+        rusage, proc_truncated = capture_output(
+            proc, {proc.stdout: stdout, proc.stderr: stderr},
+            get_output_limit(), start_time + timeout
+        )
+    finally:
+        proc.stdout.close()
+        proc.stderr.close()
+    proc_runtime = time.time() - start_time
+
+    try:
+        if proc_truncated and rusage is None:
+            # No need to wait for more output that would be thrown away
+            kill_process_group(proc, signal.SIGKILL)
+            rusage = wait_with_rusage(proc)
+        elif rusage is None:
+            rusage = wait_with_rusage(proc, timeout=max(start_time + timeout - time.time(), 0))
+            proc_runtime = time.time() - start_time
     except subprocess.TimeoutExpired:
         proc_runtime = time.time() - start_time
-        proc_retval = None
         proc_timedout = True
-        proc.terminate() # Try terminating the process nicely
-        time.sleep(0.5)
-        
-    # TODO: Clean up by halting all action (forking etc.) by the student's process
-    # with SIGSTOP and by killing the frozen processes with SIGKILL
-    #proc_killed = True
+        kill_process_group(proc, signal.SIGTERM) # Try terminating the processes nicely
+        try:
+            rusage = wait_with_rusage(proc, timeout=TERMINATE_GRACE_PERIOD)
+        except subprocess.TimeoutExpired:
+            proc_killed = True
+            kill_process_group(proc, signal.SIGKILL)
+            rusage = wait_with_rusage(proc)
+    else:
+        if not proc_truncated:
+            proc_retval = proc.returncode
 
-    # TODO: Collect statistics on CPU time consumed by the student's process
-    #import resource
-    #print(resource.getrusage(resource.RUSAGE_CHILDREN))
+    # Kill whatever the student's process left running in its process group
+    kill_process_group(proc, signal.SIGKILL)
 
-    proc_runtime = proc_runtime or (time.time() - start_time)
-    proc_retval = proc_retval or proc.returncode
     proc_results = {"retval": proc_retval,
                     "timedout": proc_timedout,
                     "killed": proc_killed,
+                    "truncated": proc_truncated,
                     "runtime": proc_runtime,
-                    "ordinal_number": command.ordinal_number,
-                    "expected_retval": command.return_value,
-                    "input_text": command.input_text,
-                    "significant_stdout": command.significant_stdout,
-                    "significant_stderr": command.significant_stderr,
+                    "cpu_user": rusage.ru_utime,
+                    "cpu_system": rusage.ru_stime,
+                    "max_rss": rusage.ru_maxrss, # kilobytes
+                    "ordinal_number": command["ordinal_number"],
+                    "expected_retval": command["return_value"],
+                    "input_text": command["input_text"],
+                    "significant_stdout": command["significant_stdout"],
+                    "significant_stderr": command["significant_stderr"],
                     "command_line": shell_like_cmd,}
 
     return proc_results
@@ -600,22 +1323,80 @@ def run_command(cmd_id, stdin, stdout, stderr, test_dir, files_to_check):
 #       - how many tests have failed, how many have been correct
 #       - how many and what kind are left
 
+# The lanes, i.e. Celery queues, of the grading tasks. Live answers go to the
+# live lane, except answers by staff and answers given close to a deadline,
+# which go to the urgent lane so that they don't wait behind the queued live
+# answers when the lane has its own worker. The queues and the routes of the
+# other tasks are set up in lovelace/celery.py.
+GRADING_LANES = ("urgent", "live", "bulk", "maintenance")
+
+def get_queue_depths():
+    """
+    Returns the number of tasks waiting in each grading lane, or None for
+    lanes whose queue doesn't exist yet.
+    """
+    depths = {}
+    with current_app.connection_or_acquire() as conn:
+        for lane in GRADING_LANES:
+            try:
+                with conn.channel() as channel:
+                    depths[lane] = channel.queue_declare(queue=lane, passive=True).message_count
+            except conn.channel_errors:
+                depths[lane] = None
+    return depths
+
 # TODO: Celery worker status checking:
 # http://stackoverflow.com/questions/8506914/detect-whether-celery-is-available-running
 def get_celery_worker_status():
+    """
+    Returns the health snapshot of the running Celery workers keyed by their
+    hostnames, or a dict with the key "errors" if there are none. Reads the
+    heartbeats recorded by the workers, so it needs no broker round trips.
+    """
     ERROR_KEY = "errors"
     try:
-        from celery.task.control import inspect
-        insp = inspect()
-        d = insp.stats()
+        d = worker_health.get_snapshot()
         if not d:
             d = { ERROR_KEY: 'No running Celery workers were found.' }
-    except IOError as e:
-        from errno import errorcode
-        msg = "Error connecting to the backend: " + str(e)
-        if len(e.args) > 0 and errorcode.get(e.args[0]) == 'ECONNREFUSED':
-            msg += ' Check that the RabbitMQ server is running.'
-        d = { ERROR_KEY: msg }
-    except ImportError as e:
-        d = { ERROR_KEY: str(e)}
+    except RedisError as e:
+        d = { ERROR_KEY: "Error connecting to Redis: " + str(e) }
     return d
+
+_heartbeat_stop = threading.Event()
+
+@worker_ready.connect(dispatch_uid="start_worker_heartbeat")
+def start_worker_heartbeat(sender=None, **kwargs):
+    """
+    Starts a thread in the worker's main process that records the health of
+    the worker for get_celery_worker_status.
+    """
+    from celery.worker import state
+    hostname = sender.hostname
+
+    def heartbeat():
+        while True:
+            try:
+                worker_health.record(hostname, len(state.active_requests), get_queue_depths())
+            except Exception as e:
+                print("Unable to record the worker heartbeat: %s" % e)
+            if _heartbeat_stop.wait(worker_health.get_interval()):
+                break
+        worker_health.remove(hostname)
+
+    thread = threading.Thread(target=heartbeat, name="worker-heartbeat")
+    thread.daemon = True
+    thread.start()
+
+@worker_shutdown.connect(dispatch_uid="stop_worker_heartbeat")
+def stop_worker_heartbeat(**kwargs):
+    _heartbeat_stop.set()
+
+@worker_ready.connect(dispatch_uid="remove_stale_templates")
+def remove_stale_templates(**kwargs):
+    """Removes the test templates of the pool processes of earlier runs."""
+    workspace.remove_stale_templates()
+
+@worker_process_shutdown.connect(dispatch_uid="remove_worker_templates")
+def remove_worker_templates(**kwargs):
+    """Removes the test templates of an exiting pool process."""
+    workspace.remove_templates()
@@ -5,7 +5,7 @@ when you run "manage.py test".
 Replace this with more appropriate tests for your application.
 """
 
-from django.test import TestCase
+from django.test import SimpleTestCase, TestCase
 
 
 class SimpleTest(TestCase):
@@ -14,3 +14,167 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+import random
+import re
+
+import courses.comparison as comparison
+import prettydiff.diffcache as diffcache
+import prettydiff.difflib as difflib
+import prettydiff.linediff as linediff
+
+class OutputComparisonTest(SimpleTestCase):
+    def test_exact(self):
+        self.assertTrue(comparison.outputs_match("a\nb\n", "a\nb\n"))
+        self.assertFalse(comparison.outputs_match("a\nb", "a\nb\n"))
+        self.assertFalse(comparison.outputs_match("a\r\nb\n", "a\nb\n", None))
+
+    def test_trailing_whitespace(self):
+        mode = comparison.TRAILING_WHITESPACE
+        self.assertTrue(comparison.outputs_match("a  \r\nb\t\n", "a\nb\n", mode))
+        self.assertFalse(comparison.outputs_match(" a\n", "a\n", mode))
+        self.assertFalse(comparison.outputs_match("a\nb\n", "a\n", mode))
+
+    def test_blank_lines(self):
+        mode = comparison.BLANK_LINES
+        self.assertTrue(comparison.outputs_match("\na\n\n  \nb\n", "a\nb\n\n", mode))
+        self.assertFalse(comparison.outputs_match("a\n\nc\n", "a\nb\n", mode))
+
+    def test_case_insensitive(self):
+        mode = comparison.CASE_INSENSITIVE
+        self.assertTrue(comparison.outputs_match("HELLO World\n", "hello world\n", mode))
+        self.assertFalse(comparison.outputs_match("hello\n", "hello \n", mode))
+
+    def test_numeric(self):
+        mode = comparison.NUMERIC
+        self.assertTrue(comparison.outputs_match("x = 1.0001\n", "x = 1\n", mode, 0.001))
+        self.assertFalse(comparison.outputs_match("x = 1.1\n", "x = 1\n", mode, 0.001))
+        self.assertFalse(comparison.outputs_match("x = 1\n", "x = 1\ny = 2\n", mode, 0.001))
+
+    def test_numbers_match(self):
+        self.assertTrue(comparison.numbers_match("1 2 3", "1 2 3", 0.0))
+        self.assertTrue(comparison.numbers_match("sum 0.30000000000000004", "sum 0.3", 1e-9))
+        self.assertTrue(comparison.numbers_match("1000001", "1000000", 1e-6))
+        self.assertFalse(comparison.numbers_match("1 2", "1 2 3", 0.1))
+        self.assertFalse(comparison.numbers_match("sum 1", "total 1", 0.1))
+        self.assertFalse(comparison.numbers_match("1.5", "1.0", 0.1))
+        self.assertFalse(comparison.numbers_match("nan", "1.0", 0.1))
+        self.assertTrue(comparison.numbers_match("inf", "inf", 0.1))
+
+    def test_numeric_key(self):
+        key = comparison.NumericKey(0.01)
+        self.assertEqual(key("x = 1.001"), key("x = 1.002"))
+        self.assertNotEqual(key("x = 1.001"), key("x = 2"))
+        self.assertNotEqual(key("x = 1"), key("y = 1"))
+        self.assertEqual(comparison.NumericKey(0.0)("a 1.5 b"), "a #1.5 b")
+
+    def test_numeric_key_overflow(self):
+        key = comparison.NumericKey(1e-6)
+        self.assertEqual(key("1e308"), "#1e+308")
+        self.assertEqual(key("-1e308 inf"), "#-1e+308 inf")
+        self.assertEqual(key("1e300"), "#%d" % round(1e300 / 1e-6))
+
+    def test_numeric_diff_matches_comparison(self):
+        for student, reference, tolerance in (("1000001", "1000000", 1e-6),
+                                              ("x 1.0049", "x 1.0051", 0.01)):
+            self.assertTrue(comparison.outputs_match(student, reference,
+                                                     comparison.NUMERIC, tolerance))
+            key = comparison.diff_key(comparison.NUMERIC, tolerance)
+            differ = linediff.PatienceDiffer(key=key, linematch=comparison.diff_linematch(key))
+            delta = list(differ.compare([student, "end"], [reference, "end"]))
+            self.assertEqual(delta, ["  " + student, "  end"])
+
+    def test_numeric_diff_cache_options(self):
+        describe = lambda tolerance: diffcache._describe(linediff.PatienceDiffer(
+            key=comparison.NumericKey(tolerance),
+            linematch=comparison.NumericKey(tolerance).match
+        ))
+        self.assertNotEqual(describe(0.1), describe(1e-6))
+        self.assertEqual(describe(0.1), describe(0.1))
+
+class LineDiffTest(SimpleTestCase):
+    def make_pairs(self):
+        rnd = random.Random(0)
+        pairs = [([], []), (["a"], []), ([], ["a"]), (["a", "b"], ["a", "b"]),
+                 (["x", "y"] * 10, ["y", "x"] * 10)]
+        for _ in range(50):
+            a = [rnd.choice("abcdefgh") for _ in range(rnd.randrange(40))]
+            b = list(a)
+            for _ in range(rnd.randrange(10)):
+                i = rnd.randrange(len(b) + 1)
+                if rnd.random() < 0.5 and i < len(b):
+                    del b[i]
+                else:
+                    b.insert(i, rnd.choice("abcdefghij"))
+            pairs.append((a, b))
+        return pairs
+
+    def assertRebuilds(self, a, b, opcodes):
+        rebuilt = []
+        i = j = 0
+        for tag, i1, i2, j1, j2 in opcodes:
+            self.assertEqual((i, j), (i1, j1))
+            if tag == "equal":
+                self.assertEqual(a[i1:i2], b[j1:j2])
+            rebuilt.extend(b[j1:j2])
+            i, j = i2, j2
+        self.assertEqual((i, j), (len(a), len(b)))
+        self.assertEqual(rebuilt, b)
+
+    def test_opcodes_rebuild_b(self):
+        for a, b in self.make_pairs():
+            matcher = linediff.PatienceSequenceMatcher(None, a, b)
+            self.assertRebuilds(a, b, matcher.get_opcodes())
+
+    def test_matching_blocks(self):
+        for a, b in self.make_pairs():
+            blocks = linediff.PatienceSequenceMatcher(None, a, b).get_matching_blocks()
+            self.assertEqual(tuple(blocks[-1]), (len(a), len(b), 0))
+            i_end = j_end = 0
+            for i, j, n in blocks[:-1]:
+                self.assertGreater(n, 0)
+                self.assertGreaterEqual(i, i_end)
+                self.assertGreaterEqual(j, j_end)
+                # Adjacent blocks are collapsed
+                self.assertFalse(i == i_end and j == j_end and i > 0)
+                self.assertEqual(a[i:i + n], b[j:j + n])
+                i_end, j_end = i + n, j + n
+
+    def test_max_cost(self):
+        # No unique lines to anchor on, so the region is diffed with Myers
+        a, b = ["x", "y"] * 10, ["y", "y", "x", "x"] * 5
+        matcher = linediff.PatienceSequenceMatcher(None, a, b, max_cost=1)
+        self.assertEqual(matcher.get_opcodes(), [("replace", 0, 20, 0, 20)])
+        matcher = linediff.PatienceSequenceMatcher(None, a, b)
+        self.assertIn("equal", [opcode[0] for opcode in matcher.get_opcodes()])
+        self.assertRebuilds(a, b, matcher.get_opcodes())
+
+    def test_key(self):
+        a, b = ["A", "b", "C"], ["a", "x", "c"]
+        matcher = linediff.PatienceSequenceMatcher(None, a, b, key=str.casefold)
+        self.assertEqual([opcode[0] for opcode in matcher.get_opcodes()],
+                         ["equal", "replace", "equal"])
+
+    def test_pages_cover_all_rows(self):
+        a = ["line %d" % i for i in range(300)]
+        b = list(a)
+        for i in range(0, 300, 23):
+            b[i] = "changed %d" % i
+        del b[100:103]
+        b.insert(200, "new")
+
+        cells = lambda table: re.findall(r'<td class="diff-linenum">([^<]*)</td>', table)
+        differ = linediff.PatienceDiffer()
+        table, next_offset = difflib.HtmlDiff(differ=differ).make_table_page(a, b)
+        self.assertIsNone(next_offset)
+
+        pages = []
+        offset = 0
+        while offset is not None:
+            page, offset = difflib.HtmlDiff(differ=differ).make_table_page(
+                a, b, offset=offset, hunks=2
+            )
+            pages.append(page)
+        self.assertGreater(len(pages), 1)
+        self.assertEqual([cell for page in pages for cell in cells(page)], cells(table))
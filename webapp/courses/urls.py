@@ -12,6 +12,8 @@ urlpatterns = [
     # For viewing and changing user information
     url(r'^answers/(?P<user>[^/]+)/(?P<answer_id>\d+)$',
         views.get_old_file_exercise_evaluation, name='get_old_file_exercise_evaluation'),
+    url(r'^evaluation/(?P<evaluation_id>\d+)/diff/(?P<test_id>\d+)/(?P<stage_id>\d+)/(?P<cmd_id>\d+)/(?P<stream>stdout|stderr)/$',
+        views.file_exercise_output_diff, name='file_exercise_output_diff'),
     url(r'^answers/(?P<user>[^/]+)/(?P<course>[^/]+)/(?P<instance>[^/]+)/(?P<exercise>[^/]+)',
         views.show_answers, name='show_answers'),
     url(r'^user/(?P<user_name>[^/]+)/$', views.user),
@@ -30,6 +32,9 @@ urlpatterns = [
     url(r'^help/markup/$', views.markup_help, name='markup_help',),
     url(r'^terms/$', views.terms, name='terms',),
 
+    # Monitoring
+    url(r'^queue-status/$', views.queue_status, name='queue_status',),
+
     # Course front page and content views
     url(r'^(?P<course_slug>[^/]+)/$', views.course_instances, name='course_instances'),
     url(r'^(?P<course_slug>[^/]+)/(?P<instance_slug>[^/]+)/$', views.course, name='course'),
@@ -14,11 +14,14 @@ from django.utils import timezone
 from django.utils.safestring import mark_safe
 from django.utils.translation import ugettext as _
 from django.contrib import messages
+from django.conf import settings
 
 from reversion import revisions as reversion
 
 from celery.result import AsyncResult
 from courses.tasks import get_celery_worker_status
+import courses.worker_health as worker_health
+import courses.result_store as result_store
 
 from courses.models import *
 from courses.forms import *
@@ -230,7 +233,7 @@ def check_answer(request, course_slug, instance_slug, content_slug, revision):
     if not exercise.manually_evaluated:
         if exercise.content_type == "FILE_UPLOAD_EXERCISE":
             task_id = evaluation["task_id"]
-            return check_progress(request, course_slug, content_slug, task_id)
+            return check_progress(request, course_slug, instance_slug, content_slug, revision, task_id)
         exercise.save_evaluation(content, user, evaluation, answer_object)
         evaluation["manual"] = False
     else:
@@ -243,24 +246,72 @@ def check_answer(request, course_slug, instance_slug, content_slug, revision):
         'evaluation': evaluation.get("evaluation"),
     })
 
+def get_task_progress(task):
+    if task.state == "PROGRESS" and isinstance(task.info, dict):
+        return task.info.get("current", 0)
+    return 0
+
 def check_progress(request, course_slug, instance_slug, content_slug, revision, task_id):
+    """
+    Returns the progress of checking a file upload exercise answer, or the
+    evaluation if it's done. When the progress the client has already seen
+    is given in the progress parameter, the request is held until the task
+    progresses or FILE_EXERCISE_PROGRESS_TIMEOUT seconds have passed.
+    """
     # Based on https://djangosnippets.org/snippets/2898/
     # TODO: Check permissions
     task = AsyncResult(task_id)
+    try:
+        seen = int(request.GET["progress"])
+    except (KeyError, ValueError):
+        pass
+    else:
+        timeout = getattr(settings, "FILE_EXERCISE_PROGRESS_TIMEOUT", 20)
+        result_store.wait_for_progress(task_id, timeout,
+                                       lambda: task.ready() or get_task_progress(task) != seen)
+
     if task.ready():
-        return file_exercise_evaluation(request, course_slug, content_slug, task_id, task)
+        return file_exercise_evaluation(request, course_slug, instance_slug, content_slug, revision, task_id, task)
     else:
-        celery_status = get_celery_worker_status()
+        # Only check the workers while no worker has picked up the task
+        celery_status = get_celery_worker_status() if task.state == "PENDING" else {}
         if "errors" in celery_status:
             data = celery_status
         else:
+            progress = get_task_progress(task)
             progress_url = reverse('courses:check_progress',
                                    kwargs={"course_slug": course_slug,
+                                           "instance_slug": instance_slug,
                                            "content_slug": content_slug,
+                                           "revision": revision,
                                            "task_id": task_id,})
+            progress_url += "?progress=%d" % progress
             data = {"state": task.state, "metadata": task.info, "redirect": progress_url}
+            if task.state == "PROGRESS" and task.info.get("tests"):
+                # Show the tests evaluated so far
+                t_file = loader.get_template("courses/file-exercise-evaluation.html")
+                data["file_tabs"] = t_file.render({'evaluation_tree': {"tests": task.info["tests"]}}, request)
+                data["metadata"] = {"current": task.info["current"], "total": task.info["total"]}
         return JsonResponse(data)
 
+def queue_status(request):
+    """
+    Returns the number of tasks waiting in each grading lane, the health of
+    the workers and the hit rate of this process's diff cache as JSON, for
+    monitoring.
+    """
+    if not request.user.is_staff:
+        return HttpResponseForbidden("Only staff members can view the queue status.")
+    workers = get_celery_worker_status()
+    if "errors" in workers:
+        return JsonResponse(workers)
+    from .tasks import get_diff_cache
+    return JsonResponse({
+        "queues": worker_health.get_queue_depths(workers),
+        "workers": workers,
+        "diff_cache": get_diff_cache().stats(),
+    })
+
 def file_exercise_evaluation(request, course_slug, instance_slug, content_slug, revision, task_id, task=None):
     if task is None:
         task = AsyncResult(task_id)
@@ -268,19 +319,21 @@ def file_exercise_evaluation(request, course_slug, instance_slug, content_slug,
     task.forget() # TODO: IMPORTANT! Also forget all the subtask results somehow? in tasks.py?
     evaluation_obj = Evaluation.objects.get(id=evaluation_id)
 
-    # TODO: Nicer way to get the proper address!
-    import redis
-    r = redis.StrictRedis(host='localhost', port=6379, db=0)
-    evaluation_json = r.get(task_id).decode("utf-8")
-    evaluation_tree = json.loads(evaluation_json)
-    r.delete(task_id)
-
-    debug_json = json.dumps(evaluation_tree, indent=4)
+    stored = result_store.load(task_id)
+    if stored is not None:
+        evaluation_tree = stored.tree
+        debug_json = lambda: stored.json
+    else:
+        # The stored evaluation has expired, render it again
+        from .tasks import generate_results
+        evaluation_tree = generate_results(json.loads(evaluation_obj.test_results), 0)
+        debug_json = lambda: json.dumps(evaluation_tree, indent=4)
 
     t_file = loader.get_template("courses/file-exercise-evaluation.html")
     c_file = {
-        'debug_json': debug_json,
+        'debug_json': debug_json, # Only serialized if shown
         'evaluation_tree': evaluation_tree["test_tree"],
+        'evaluation_id': evaluation_obj.id,
     }
     t_exercise = loader.get_template("courses/exercise-evaluation.html")
     c_exercise = {
@@ -320,15 +373,60 @@ def get_old_file_exercise_evaluation(request, user, answer_id):
 
     evaluation_dict = generate_results(results_dict, 0)
 
-    debug_json = json.dumps(evaluation_dict, indent=4)
+    debug_json = lambda: json.dumps(evaluation_dict, indent=4)
 
     t_file = loader.get_template("courses/file-exercise-evaluation.html")
     c_file = {
         'debug_json': debug_json,
         'evaluation_tree': evaluation_dict["test_tree"],
+        'evaluation_id': answer_obj.evaluation.id,
     }
     return HttpResponse(t_file.render(c_file, request))
 
+def file_exercise_output_diff(request, evaluation_id, test_id, stage_id, cmd_id, stream):
+    """
+    Renders the diff between the student's and the reference output of a
+    single command, when the student opens it in the evaluation view. Long
+    diffs are shown a page of hunks at a time, ?offset=N gives the page
+    starting from hunk N.
+    """
+    try:
+        evaluation_obj = Evaluation.objects.get(id=evaluation_id)
+    except Evaluation.DoesNotExist as e:
+        return HttpResponseNotFound("No such evaluation {}".format(evaluation_id))
+
+    if not request.user.is_staff and not UserFileUploadExerciseAnswer.objects.filter(
+            evaluation=evaluation_obj, user_id=request.user.id).exists():
+        return HttpResponseForbidden("You're only allowed to view your own answers.")
+
+    results = json.loads(evaluation_obj.test_results)
+    try:
+        student_c = results["student"][test_id]["stages"][stage_id]["commands"][cmd_id]
+        reference_t = results["reference"][test_id]
+        reference_output = ""
+        if reference_t is not None:
+            reference_output = reference_t["stages"][stage_id]["commands"][cmd_id][stream]
+    except KeyError as e:
+        return HttpResponseNotFound("No such command {}".format(cmd_id))
+
+    try:
+        offset = int(request.GET.get("offset", 0))
+    except ValueError:
+        offset = 0
+
+    from .tasks import render_output_diff
+    table, next_offset = render_output_diff(
+        stream, student_c[stream], reference_output, offset,
+        student_c.get("comparison_mode", "EXACT"), student_c.get("numeric_tolerance", 0.0)
+    )
+    if next_offset is not None:
+        # The rest of the hunks are fetched when the student asks for them
+        more_url = "%s?offset=%d" % (request.path, next_offset)
+        table += '<div class="test-evaluation-diff"><a href="%s" onclick="show_output_diff(event, this);">%s</a></div>' % (
+            more_url, "Show more differences"
+        )
+    return HttpResponse(table)
+
 @cookie_law
 def sandboxed_content(request, content_slug, **kwargs):
     try:
@@ -0,0 +1,60 @@
+"""
+Health snapshot of the Celery workers.
+
+Every worker records its liveness, the number of tasks it is running and the
+lengths of the grading queues into a Redis hash every few seconds (see the
+heartbeat in courses/tasks.py). The views read the snapshot from there
+instead of broadcasting to the workers on each request.
+"""
+import json
+import time
+
+from django.conf import settings
+
+import courses.result_store as result_store
+
+HEALTH_KEY = "celery-worker-health"
+
+def get_interval():
+    """
+    Returns the number of seconds between the heartbeats of a worker, set
+    with FILE_EXERCISE_WORKER_HEARTBEAT_INTERVAL in settings.
+    """
+    return getattr(settings, "FILE_EXERCISE_WORKER_HEARTBEAT_INTERVAL", 5)
+
+def record(hostname, active, queues):
+    """Records a heartbeat of a worker."""
+    data = {"timestamp": time.time(), "active": active, "queues": queues}
+    result_store.get_client().hset(HEALTH_KEY, hostname, json.dumps(data))
+
+def remove(hostname):
+    """Removes a worker that is shutting down from the snapshot."""
+    result_store.get_client().hdel(HEALTH_KEY, hostname)
+
+def get_snapshot():
+    """
+    Returns the workers that have sent a heartbeat within the last three
+    intervals as a dict keyed by the worker's hostname. Workers that have
+    stopped sending heartbeats are dropped.
+    """
+    client = result_store.get_client()
+    max_age = 3 * get_interval()
+    now = time.time()
+
+    workers = {}
+    stale = []
+    for hostname, data in client.hgetall(HEALTH_KEY).items():
+        worker = json.loads(data.decode("utf-8"))
+        if now - worker["timestamp"] > max_age:
+            stale.append(hostname)
+        else:
+            workers[hostname.decode("utf-8")] = worker
+    if stale:
+        client.hdel(HEALTH_KEY, *stale)
+    return workers
+
+def get_queue_depths(workers):
+    """Returns the queue lengths reported in the latest heartbeat."""
+    if not workers:
+        return {}
+    return max(workers.values(), key=lambda worker: worker["timestamp"])["queues"]
@@ -0,0 +1,143 @@
+"""
+Workspace management for running file upload exercise tests.
+
+All test directories are created under a configurable root, which should be a
+RAM-backed file system (tmpfs). The include files required by each test are
+written only once per worker process into a template directory, which is then
+cloned for every test run. The templates are named after the process, so that
+the ones left behind by processes that have exited can be swept away.
+"""
+import atexit
+import collections
+import contextlib
+import hashlib
+import os
+import re
+import shutil
+import tempfile
+import threading
+
+from django.conf import settings
+
+import courses.file_cache as file_cache
+
+_templates = collections.OrderedDict()
+_templates_lock = threading.Lock()
+
+_TEMPLATE_NAME = re.compile(r"^template-(\d+)-")
+
+def get_root():
+    """
+    Returns the directory under which the test workspaces are created. Set
+    FILE_EXERCISE_WORKSPACE_ROOT in settings to the mount point of a tmpfs;
+    by default /dev/shm is used when available.
+    """
+    root = getattr(settings, "FILE_EXERCISE_WORKSPACE_ROOT", None)
+    if root is None:
+        root = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+    os.makedirs(root, exist_ok=True)
+    return root
+
+def clone_tree(src, dst):
+    """
+    Clones the directory src into dst. With FILE_EXERCISE_WORKSPACE_CLONE set
+    to "hardlink" the files are hard linked instead of copied, which is only
+    safe if the tested programs can't modify the files they are given.
+    """
+    if getattr(settings, "FILE_EXERCISE_WORKSPACE_CLONE", "copy") == "hardlink":
+        try:
+            shutil.copytree(src, dst, symlinks=True, copy_function=os.link)
+            return
+        except (OSError, shutil.Error):
+            # E.g. the template is on another file system
+            shutil.rmtree(dst, ignore_errors=True)
+    shutil.copytree(src, dst, symlinks=True)
+
+def _template_key(include_files):
+    h = hashlib.sha1()
+    for f in sorted(include_files, key=lambda f: f["id"]):
+        stat = os.stat(f["path"])
+        h.update(repr((f["id"], f["name"], f["path"], stat.st_mtime_ns, stat.st_size)).encode("utf-8"))
+    return h.hexdigest()
+
+def get_template(test_id, include_files):
+    """
+    Returns a template directory containing the given include files (as
+    described in the test plan) of a test. The template is rebuilt when the
+    files change. The templates of the FILE_EXERCISE_WORKSPACE_TEMPLATES (64
+    by default) most recently run tests are kept.
+    """
+    key = _template_key(include_files)
+    with _templates_lock:
+        cached = _templates.get(test_id)
+        if cached is not None and cached[0] == key and os.path.isdir(cached[1]):
+            _templates.move_to_end(test_id)
+            return cached[1]
+
+        path = tempfile.mkdtemp(prefix="template-%d-%d-" % (os.getpid(), test_id),
+                                dir=get_root())
+        for f in include_files:
+            with open(os.path.join(path, f["name"]), "wb") as fd:
+                fd.write(file_cache.read_file(f["path"]))
+            # TODO: chmod, chown, chgrp
+        if cached is not None:
+            shutil.rmtree(cached[1], ignore_errors=True)
+        _templates[test_id] = (key, path)
+        _templates.move_to_end(test_id)
+        while len(_templates) > getattr(settings, "FILE_EXERCISE_WORKSPACE_TEMPLATES", 64):
+            _, (_, evicted_path) = _templates.popitem(last=False)
+            shutil.rmtree(evicted_path, ignore_errors=True)
+        return path
+
+@atexit.register
+def remove_templates():
+    """
+    Removes the templates of this process. Celery's pool processes exit
+    without running atexit, so this is also called on worker_process_shutdown.
+    """
+    with _templates_lock:
+        for key, path in _templates.values():
+            shutil.rmtree(path, ignore_errors=True)
+        _templates.clear()
+
+def _process_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def remove_stale_templates():
+    """
+    Removes the templates left behind in the workspace root by processes
+    that no longer exist, e.g. pool processes that were killed.
+    """
+    root = get_root()
+    for name in os.listdir(root):
+        match = _TEMPLATE_NAME.match(name)
+        if match is None or _process_exists(int(match.group(1))):
+            continue
+        path = os.path.join(root, name)
+        if os.path.isdir(path):
+            print("Removing the stale test template %s" % path)
+            shutil.rmtree(path, ignore_errors=True)
+
+@contextlib.contextmanager
+def test_workspace(*sources):
+    """
+    Yields a new test directory, which is removed afterwards. The directory
+    is initialized by cloning the first source directory and copying the
+    files of the rest over it.
+    """
+    with tempfile.TemporaryDirectory(dir=get_root()) as temp_dir:
+        test_dir = os.path.join(temp_dir, "test")
+        if sources:
+            clone_tree(sources[0], test_dir)
+        else:
+            os.mkdir(test_dir)
+        for source in sources[1:]:
+            for name in os.listdir(source):
+                shutil.copy2(os.path.join(source, name), os.path.join(test_dir, name))
+        yield test_dir
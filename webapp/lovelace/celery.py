@@ -3,6 +3,7 @@ from __future__ import absolute_import
 import os
 
 from celery import Celery
+from kombu import Queue
 
 from django.conf import settings
 
@@ -16,6 +17,30 @@ app = Celery('lovelace')
 app.config_from_object('django.conf:settings')
 app.autodiscover_tasks(lambda: settings.INSTALLED_APPS)
 
+# Separate lanes for live answers, bulk regrading and maintenance jobs, so
+# that background work can't hold up the students (see courses/tasks.py). A
+# worker started without -Q consumes all of them; run a worker per lane to
+# give each lane its own concurrency. A worker consumes its queues round
+# robin, so a worker with -Q urgent,live doesn't give urgent tasks strict
+# priority over live ones. Give the urgent lane a dedicated worker to keep
+# it ahead of the queued live answers, e.g.
+#   celery -A lovelace worker -Q urgent -c 2
+#   celery -A lovelace worker -Q live -c 8
+#   celery -A lovelace worker -Q celery,bulk,maintenance -c 2
+# Each task also runs the tests of an answer in FILE_EXERCISE_TEST_CONCURRENCY
+# threads, so keep the sum of -c times that at about the number of CPUs of
+# the machine (see get_test_concurrency in courses/tasks.py).
+app.conf.update(
+    CELERY_QUEUES=getattr(settings, "CELERY_QUEUES", None) or tuple(
+        Queue(name) for name in ("celery", "urgent", "live", "bulk", "maintenance")
+    ),
+    CELERY_ROUTES=getattr(settings, "CELERY_ROUTES", None) or {
+        "courses.run-fileexercise-tests": {"queue": "live"},
+        "courses.regrade-answers": {"queue": "bulk"},
+        "stats.generate-stats": {"queue": "maintenance"},
+    },
+)
+
 
 @app.task(bind=True)
 def debug_task(self):
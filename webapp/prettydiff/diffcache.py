@@ -0,0 +1,189 @@
+"""
+Memoization of diffs by the contents of the compared sequences.
+
+The same reference output is compared to a great many student outputs, many
+of which are identical to each other, so the rendered tables and opcodes are
+cached under the hashes of the from and to lines and the options used. The
+cache keeps the most recently used results in memory up to max_size bytes,
+and can be backed by a shared cache (any object with get(key) and
+set(key, value, timeout) methods, such as a Django cache) so that the results
+are shared between processes.
+
+    cache = DiffCache(backend=django_cache)
+    table = CachedHtmlDiff(cache=cache).make_table(fromlines, tolines)
+    opcodes = cache.get_opcodes(fromlines, tolines)
+"""
+
+import collections
+import hashlib
+import threading
+import types
+
+from prettydiff.difflib import HtmlDiff, SequenceMatcher, IS_CHARACTER_JUNK
+
+__all__ = ['DiffCache', 'CachedHtmlDiff', 'lines_hash', 'get_cache', 'set_cache']
+
+_DEFAULT_MAX_SIZE = 32 * 1024 * 1024
+
+def lines_hash(lines):
+    """Returns a hash of a sequence of lines."""
+    h = hashlib.sha1()
+    for line in lines:
+        data = line.encode('utf-8', 'surrogatepass') if isinstance(line, str) else bytes(line)
+        h.update(b'%d:' % len(data))
+        h.update(data)
+    return h.hexdigest()
+
+def _describe(value):
+    """Describes an option value for a cache key"""
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return repr(value)
+    # Bound methods depend on their object, e.g. the tolerance of a line key
+    owner = getattr(value, '__self__', None)
+    if owner is not None and not isinstance(owner, types.ModuleType):
+        return '%s.%s' % (_describe(owner), value.__name__)
+    if callable(value) and hasattr(value, '__qualname__'):
+        return value.__qualname__
+    return '%s(%s)' % (type(value).__name__, ','.join(
+        '%s=%s' % (k, _describe(v)) for k, v in sorted(vars(value).items())
+        if not k.startswith('_')
+    ))
+
+def _sizeof(value):
+    """Estimates the memory used by a cached value"""
+    if isinstance(value, (str, bytes)):
+        return len(value)
+    if isinstance(value, (tuple, list)):
+        return 8 * len(value) + sum(_sizeof(item) for item in value)
+    return 64
+
+class DiffCache(object):
+    """
+    Size-bounded LRU cache for diff results, optionally in front of a shared
+    backend. Safe to use from several threads.
+    """
+
+    def __init__(self, max_size=_DEFAULT_MAX_SIZE, backend=None, timeout=None,
+                 prefix='prettydiff'):
+        self.max_size = max_size
+        self.backend = backend
+        self.timeout = timeout
+        self.prefix = prefix
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def make_key(self, kind, fromlines, tolines, options):
+        return '%s:%s:%s:%s:%s' % (
+            self.prefix, kind, lines_hash(fromlines), lines_hash(tolines),
+            hashlib.sha1(repr(options).encode('utf-8')).hexdigest()
+        )
+
+    def _remember(self, key, value):
+        size = _sizeof(value)
+        if size > self.max_size:
+            return
+        with self._lock:
+            if key in self._entries:
+                return
+            self._entries[key] = (value, size)
+            self.size += size
+            while self.size > self.max_size:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.size -= evicted_size
+
+    def get_or_compute(self, kind, fromlines, tolines, options, compute):
+        """
+        Returns the cached result of comparing fromlines to tolines with the
+        given options, or computes it with compute() and caches it.
+        """
+        key = self.make_key(kind, fromlines, tolines, options)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+
+        value = self.backend.get(key) if self.backend is not None else None
+        if value is None:
+            with self._lock:
+                self.misses += 1
+            value = compute()
+            if self.backend is not None:
+                self.backend.set(key, value, self.timeout)
+        else:
+            with self._lock:
+                self.hits += 1
+        self._remember(key, value)
+        return value
+
+    def get_opcodes(self, a, b, matcher=SequenceMatcher, **options):
+        """Returns the opcodes of matcher(None, a, b, **options), memoized."""
+        key_options = (_describe(matcher), sorted(options.items()))
+        return self.get_or_compute(
+            'opcodes', a, b, key_options,
+            lambda: matcher(None, a, b, **options).get_opcodes()
+        )
+
+    def stats(self):
+        """Returns the hit and miss counts, the hit rate and the memory use."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'entries': len(self._entries),
+                'size': self.size,
+            }
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+            self.hits = self.misses = 0
+
+_cache = DiffCache()
+
+def get_cache():
+    """Returns the cache used by default by CachedHtmlDiff."""
+    return _cache
+
+def set_cache(cache):
+    """Replaces the default cache, e.g. with one backed by a shared cache."""
+    global _cache
+    _cache = cache
+
+class CachedHtmlDiff(HtmlDiff):
+    """HtmlDiff that memoizes the tables it makes in a DiffCache."""
+
+    def __init__(self, tabsize=8, wrapcolumn=None, linejunk=None,
+                 charjunk=IS_CHARACTER_JUNK, differ=None, cache=None):
+        HtmlDiff.__init__(self, tabsize, wrapcolumn, linejunk, charjunk, differ)
+        self._cache = cache
+
+    def _options(self, *args):
+        return (self._tabsize, self._wrapcolumn, _describe(self._linejunk),
+                _describe(self._charjunk), _describe(self._differ)) + args
+
+    def make_table(self, fromlines, tolines, fromdesc='', todesc='', context=False,
+                   numlines=5):
+        cache = self._cache or get_cache()
+        return cache.get_or_compute(
+            'table', fromlines, tolines, self._options(fromdesc, todesc, context, numlines),
+            lambda: HtmlDiff.make_table(self, fromlines, tolines, fromdesc, todesc,
+                                        context, numlines)
+        )
+
+    def make_table_page(self, fromlines, tolines, fromdesc='', todesc='', numlines=5,
+                        offset=0, hunks=None):
+        cache = self._cache or get_cache()
+        return cache.get_or_compute(
+            'page', fromlines, tolines,
+            self._options(fromdesc, todesc, numlines, offset, hunks),
+            lambda: HtmlDiff.make_table_page(self, fromlines, tolines, fromdesc, todesc,
+                                             numlines, offset, hunks)
+        )
@@ -31,6 +31,7 @@ __all__ = ['get_close_matches', 'ndiff', 'restore', 'SequenceMatcher',
            'unified_diff', 'HtmlDiff', 'Match']
 
 import heapq
+import collections
 from collections import namedtuple as _namedtuple
 
 Match = _namedtuple('Match', 'a b size')
@@ -1330,7 +1331,7 @@ def ndiff(a, b, linejunk=None, charjunk=IS_CHARACTER_JUNK):
     return Differ(linejunk, charjunk).compare(a, b)
 
 def _mdiff(fromlines, tolines, context=None, linejunk=None,
-           charjunk=IS_CHARACTER_JUNK):
+           charjunk=IS_CHARACTER_JUNK, differ=None):
     r"""Returns generator yielding marked up from/to side by side differences.
 
     Arguments:
@@ -1340,6 +1341,8 @@ def _mdiff(fromlines, tolines, context=None, linejunk=None,
                if None, all from/to text lines will be generated.
     linejunk -- passed on to ndiff (see ndiff documentation)
     charjunk -- passed on to ndiff (see ndiff documentation)
+    differ -- Differ instance used instead of ndiff, e.g. a
+              linediff.PatienceDiffer
 
     This function returns an iterator which returns a tuple:
     (from line tuple, to line tuple, boolean flag)
@@ -1369,7 +1372,10 @@ def _mdiff(fromlines, tolines, context=None, linejunk=None,
     change_re = re.compile('(\++|\-+|\^+)')
 
     # create the difference iterator to generate the differences
-    diff_lines_iterator = ndiff(fromlines,tolines,linejunk,charjunk)
+    if differ is None:
+        diff_lines_iterator = ndiff(fromlines,tolines,linejunk,charjunk)
+    else:
+        diff_lines_iterator = differ.compare(fromlines,tolines)
 
     def _make_line(lines, format_key, side, num_lines=[0,0]):
         """Returns line of text with user's change markup and line formatting.
@@ -1514,7 +1520,7 @@ def _mdiff(fromlines, tolines, context=None, linejunk=None,
                 num_blanks_to_yield -= 1
                 yield ('','\n'),None,True
             if s.startswith('X'):
-                raise StopIteration
+                return
             else:
                 yield from_line,to_line,True
 
@@ -1536,7 +1542,10 @@ def _mdiff(fromlines, tolines, context=None, linejunk=None,
         while True:
             # Collecting lines of text until we have a from/to pair
             while (len(fromlines)==0 or len(tolines)==0):
-                from_line, to_line, found_diff = next(line_iterator)
+                try:
+                    from_line, to_line, found_diff = next(line_iterator)
+                except StopIteration:
+                    return
                 if from_line is not None:
                     fromlines.append((from_line,found_diff))
                 if to_line is not None:
@@ -1550,8 +1559,7 @@ def _mdiff(fromlines, tolines, context=None, linejunk=None,
     # them up without doing anything else with them.
     line_pair_iterator = _line_pair_iterator()
     if context is None:
-        while True:
-            yield next(line_pair_iterator)
+        yield from line_pair_iterator
     # Handle case where user wants context differencing.  We must do some
     # storage of lines until we know for sure that they are to be yielded.
     else:
@@ -1564,7 +1572,10 @@ def _mdiff(fromlines, tolines, context=None, linejunk=None,
             index, contextLines = 0, [None]*(context)
             found_diff = False
             while(found_diff is False):
-                from_line, to_line, found_diff = next(line_pair_iterator)
+                try:
+                    from_line, to_line, found_diff = next(line_pair_iterator)
+                except StopIteration:
+                    return
                 i = index % context
                 contextLines[i] = (from_line, to_line, found_diff)
                 index += 1
@@ -1584,7 +1595,10 @@ def _mdiff(fromlines, tolines, context=None, linejunk=None,
             # Now yield the context lines after the change
             lines_to_write = context-1
             while(lines_to_write):
-                from_line, to_line, found_diff = next(line_pair_iterator)
+                try:
+                    from_line, to_line, found_diff = next(line_pair_iterator)
+                except StopIteration:
+                    return
                 # If another change within the context, extend the context
                 if found_diff:
                     lines_to_write = context-1
@@ -1668,6 +1682,9 @@ class HtmlDiff(object):
 
     make_table -- generates HTML for a single side by side table
     make_file -- generates complete HTML file with a single side by side table
+    iter_table -- generates the HTML of a table with folded context piece by
+        piece, optionally a page of its hunks at a time
+    make_table_page -- generates HTML for one page of hunks of a table
 
     See tools/scripts/diff.py for an example usage of this class.
     """
@@ -1680,7 +1697,7 @@ class HtmlDiff(object):
 
     # TODO: Add more options for HTML customization
     def __init__(self,tabsize=8,wrapcolumn=None,linejunk=None,
-                 charjunk=IS_CHARACTER_JUNK):
+                 charjunk=IS_CHARACTER_JUNK,differ=None):
         """HtmlDiff instance initializer
 
         Arguments:
@@ -1690,8 +1707,11 @@ class HtmlDiff(object):
         linejunk,charjunk -- keyword arguments passed into ndiff() (used to by
             HtmlDiff() to generate the side by side HTML differences).  See
             ndiff() documentation for argument default values and descriptions.
+        differ -- Differ instance used to compare the lines instead of ndiff(),
+            e.g. a linediff.PatienceDiffer for large outputs.
         """
         self._tabsize = tabsize
+        self._differ = differ
         self._wrapcolumn = wrapcolumn
         self._linejunk = linejunk
         self._charjunk = charjunk
@@ -1961,7 +1981,7 @@ class HtmlDiff(object):
         else:
             context_lines = None
         diffs = _mdiff(fromlines,tolines,context_lines,linejunk=self._linejunk,
-                      charjunk=self._charjunk)
+                      charjunk=self._charjunk,differ=self._differ)
 
         # set up iterator to wrap lines that exceed desired width
         if self._wrapcolumn:
@@ -2000,11 +2020,126 @@ class HtmlDiff(object):
             header_row=header_row,
             prefix=self._prefix[1])
 
-        return table.replace('\0+','<span class="diff-add">'). \
-                     replace('\0-','<span class="diff-sub">'). \
-                     replace('\0^','<span class="diff-chg">'). \
-                     replace('\1','</span>'). \
-                     replace('\t','&nbsp;')
+        return self._markup(table)
+
+    def _markup(self,text):
+        """Replaces the change marks with the change markup"""
+        return text.replace('\0+','<span class="diff-add">'). \
+                    replace('\0-','<span class="diff-sub">'). \
+                    replace('\0^','<span class="diff-chg">'). \
+                    replace('\1','</span>'). \
+                    replace('\t','&nbsp;')
+
+    def _header_row(self,fromdesc,todesc):
+        if not (fromdesc or todesc):
+            return ''
+        esc = lambda s: s.replace("&","&amp;").replace(">","&gt;").replace("<","&lt;")\
+                    .replace("'","&apos;").replace('"',"&quot;")
+        return '<thead><tr>%s%s</tr></thead>' % (
+            '<th colspan="2" class="diff-header">%s</th>' % esc(fromdesc),
+            '<th colspan="2" class="diff-header">%s</th>' % esc(todesc))
+
+    def _iter_rows(self,fromlines,tolines):
+        """Yields (flag, row HTML) pairs of the full side by side diff"""
+        fromlines,tolines = self._tab_newline_replace(fromlines,tolines)
+        diffs = _mdiff(fromlines,tolines,None,linejunk=self._linejunk,
+                       charjunk=self._charjunk,differ=self._differ)
+        if self._wrapcolumn:
+            diffs = self._line_wrapper(diffs)
+        fmt = '    <tr>%s%s</tr>\n'
+        for fromdata,todata,flag in diffs:
+            yield flag, self._markup(fmt % (self._format_line(0,flag,*fromdata),
+                                            self._format_line(1,flag,*todata)))
+
+    def _fold_toggle(self,count):
+        return ('        </tbody>\n        <tbody class="diff-fold-toggle">\n'
+                '    <tr><td colspan="4"><a href="#" onclick="toggle_diff_fold(event, this);">'
+                '%d unchanged lines</a></td></tr>\n        </tbody>\n        <tbody>\n' % count)
+
+    def iter_table(self,fromlines,tolines,fromdesc='',todesc='',numlines=5,
+                   offset=0,hunks=None):
+        """Generates an HTML table of side by side comparison piece by piece
+
+        Arguments are as for make_table, and in addition:
+        offset -- index of the first hunk to include
+        hunks -- number of hunks to include, all of them if None
+
+        A hunk is a run of changes separated by at most 2*numlines unchanged
+        lines. Longer unchanged runs are folded into hidden table bodies,
+        leaving numlines lines of context around the changes. Only the rows
+        of the requested hunks are generated, and neither the diff nor the
+        table is held in memory as a whole.
+
+        Once the generator is exhausted, the next_offset attribute is the
+        offset of the next page of hunks, or None if there are no more.
+        """
+        self._make_prefix()
+        self.next_offset = None
+        end = offset + hunks if hunks is not None else None
+
+        head, tail = self._table_template.split('%(data_rows)s')
+        yield head % dict(header_row=self._header_row(fromdesc,todesc))
+
+        pending = collections.deque()
+        trailing = numlines
+        folded = 0
+        fold_open = False
+        hunk = -1
+        emitting = offset == 0
+
+        for flag, row in self._iter_rows(fromlines,tolines):
+            if not flag:
+                if trailing:
+                    trailing -= 1
+                    if emitting:
+                        yield row
+                    continue
+                pending.append(row)
+                if len(pending) > numlines:
+                    row = pending.popleft()
+                    folded += 1
+                    if emitting:
+                        if not fold_open:
+                            fold_open = True
+                            yield '        </tbody>\n        <tbody class="diff-fold" style="display: none;">\n'
+                        yield row
+                continue
+
+            if hunk < 0 or folded:
+                hunk += 1
+                if end is not None and hunk >= end:
+                    self.next_offset = hunk
+                    break
+                if emitting and fold_open:
+                    yield self._fold_toggle(folded)
+                emitting = hunk >= offset
+            fold_open = False
+            folded = 0
+            if emitting:
+                yield ''.join(pending)
+                yield row
+            pending.clear()
+            trailing = numlines
+        else:
+            if emitting:
+                if fold_open:
+                    yield self._fold_toggle(folded)
+                yield ''.join(pending)
+
+        if self.next_offset is not None and emitting and fold_open:
+            yield self._fold_toggle(folded)
+        yield tail
+
+    def make_table_page(self,fromlines,tolines,fromdesc='',todesc='',numlines=5,
+                        offset=0,hunks=None):
+        """Returns one page of hunks of an HTML table with folded context
+
+        See iter_table for the arguments. Returns the table and the offset of
+        the next page, or None if this was the last page.
+        """
+        table = ''.join(self.iter_table(fromlines,tolines,fromdesc,todesc,
+                                        numlines,offset,hunks))
+        return table, self.next_offset
 
 del re
 
@@ -0,0 +1,314 @@
+"""
+Line diff backend for HtmlDiff that stays fast on large, mostly different
+outputs.
+
+The lines are interned into integers, so that lines are only hashed once and
+compared as numbers. The common prefix and suffix are stripped, and the rest
+is split at the lines that occur exactly once in both sequences (patience
+diff). The regions between those anchors are diffed with Myers' linear space
+O(ND) algorithm. If a region needs more than max_cost edits, the search is
+given up and the region is reported as replaced.
+
+PatienceSequenceMatcher produces the same matching blocks and opcodes as
+difflib.SequenceMatcher, and PatienceDiffer can be given to HtmlDiff:
+
+    HtmlDiff(differ=PatienceDiffer(intraline_max_lines=100))
+
+The differ only does intraline highlighting for replaced blocks of at most
+intraline_max_lines lines on each side whose lines are at most
+intraline_max_length characters long. Other blocks are shown as plain
+deletions and insertions.
+
+Lines can be matched by key(line), which has to be the same for lines that
+are considered equal. A looser rule can be given as linematch(a_line,
+b_line): the lines of replaced blocks are paired up in order, and the pairs
+it accepts are shown as unchanged.
+"""
+
+import bisect
+
+from prettydiff.difflib import SequenceMatcher, Differ, Match, IS_CHARACTER_JUNK
+
+__all__ = ['PatienceSequenceMatcher', 'PatienceDiffer', 'intern_lines']
+
+def intern_lines(a, b, key=None):
+    """
+    Returns a and b with each distinct line replaced by the same integer.
+    With key, lines with the same key(line) are considered the same.
+    """
+    ids = {}
+    if key is None:
+        intern = lambda line: ids.setdefault(line, len(ids))
+    else:
+        intern = lambda line: ids.setdefault(key(line), len(ids))
+    return [intern(line) for line in a], [intern(line) for line in b]
+
+def _unique_anchors(a, alo, ahi, b, blo, bhi):
+    """
+    Returns the (i, j) pairs of lines that occur exactly once in both ranges
+    and keep their order in both, i.e. the longest increasing subsequence of
+    the unique common lines. Returns None if the ranges have no lines in
+    common at all.
+    """
+    counts = {}
+    for i in range(alo, ahi):
+        count = counts.get(a[i])
+        counts[a[i]] = [1, i, 0, None] if count is None else [count[0] + 1, i, 0, None]
+    for j in range(blo, bhi):
+        count = counts.get(b[j])
+        if count is not None:
+            count[2] += 1
+            count[3] = j
+    if not any(n_b for n_a, i, n_b, j in counts.values()):
+        return None
+    pairs = sorted((i, j) for n_a, i, n_b, j in counts.values() if n_a == 1 and n_b == 1)
+    if not pairs:
+        return []
+
+    # Patience sorting: tails[k] is the index of the pair ending the best
+    # increasing subsequence of length k + 1
+    tails = []
+    tail_js = []
+    previous = [None] * len(pairs)
+    for index, (i, j) in enumerate(pairs):
+        k = bisect.bisect_left(tail_js, j)
+        if k:
+            previous[index] = tails[k - 1]
+        if k == len(tails):
+            tails.append(index)
+            tail_js.append(j)
+        else:
+            tails[k] = index
+            tail_js[k] = j
+
+    anchors = []
+    index = tails[-1]
+    while index is not None:
+        anchors.append(pairs[index])
+        index = previous[index]
+    anchors.reverse()
+    return anchors
+
+def _middle_snake(a, alo, ahi, b, blo, bhi, max_cost):
+    """
+    Finds the middle snake of the shortest edit script between the ranges.
+    Returns (edit distance, x0, y0, x1, y1) with the snake from (x0, y0) to
+    (x1, y1) relative to alo and blo, or None if the edit distance exceeds
+    max_cost.
+    """
+    n, m = ahi - alo, bhi - blo
+    delta = n - m
+    odd = delta & 1
+    max_d = min((n + m + 1) // 2, max_cost)
+    offset = max_d + 1
+    forward = [0] * (2 * offset + 1)
+    backward = [0] * (2 * offset + 1)
+
+    for d in range(max_d + 1):
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and forward[offset + k - 1] < forward[offset + k + 1]):
+                x = forward[offset + k + 1]
+            else:
+                x = forward[offset + k - 1] + 1
+            y = x - k
+            x0, y0 = x, y
+            while x < n and y < m and a[alo + x] == b[blo + y]:
+                x += 1
+                y += 1
+            forward[offset + k] = x
+            if odd and delta - (d - 1) <= k <= delta + (d - 1):
+                if x + backward[offset + delta - k] >= n:
+                    return 2 * d - 1, x0, y0, x, y
+
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and backward[offset + k - 1] < backward[offset + k + 1]):
+                x = backward[offset + k + 1]
+            else:
+                x = backward[offset + k - 1] + 1
+            y = x - k
+            x0, y0 = x, y
+            while x < n and y < m and a[ahi - 1 - x] == b[bhi - 1 - y]:
+                x += 1
+                y += 1
+            backward[offset + k] = x
+            if not odd and -d <= delta - k <= d:
+                if x + forward[offset + delta - k] >= n:
+                    return 2 * d, n - x, m - y, n - x0, m - y0
+    return None
+
+class PatienceSequenceMatcher(SequenceMatcher):
+    """
+    SequenceMatcher for sequences of hashable items (usually lines) that
+    finds the matching blocks with the patience and Myers algorithms. Junk
+    isn't supported, so isjunk is ignored. If key is given, items are
+    matched by key(item).
+    """
+
+    def __init__(self, isjunk=None, a='', b='', autojunk=True, max_cost=500, key=None):
+        self.max_cost = max_cost
+        self.key = key
+        SequenceMatcher.__init__(self, None, a, b, False)
+
+    def set_seq2(self, b):
+        # The b2j index of SequenceMatcher isn't needed
+        if b is self.b:
+            return
+        self.b = b
+        self.matching_blocks = self.opcodes = None
+        self.fullbcount = None
+
+    def get_matching_blocks(self):
+        """Return list of triples describing matching subsequences.
+
+        See SequenceMatcher.get_matching_blocks; the blocks have the same
+        format, but need not be the same ones.
+        """
+        if self.matching_blocks is not None:
+            return self.matching_blocks
+        a, b = intern_lines(self.a, self.b, self.key)
+        la, lb = len(a), len(b)
+
+        matches = []
+        queue = [(0, la, 0, lb)]
+        while queue:
+            alo, ahi, blo, bhi = queue.pop()
+
+            # Common prefix and suffix
+            start = alo
+            while alo < ahi and blo < bhi and a[alo] == b[blo]:
+                alo += 1
+                blo += 1
+            if alo > start:
+                matches.append((start, blo - (alo - start), alo - start))
+            end = ahi
+            while alo < ahi and blo < bhi and a[ahi - 1] == b[bhi - 1]:
+                ahi -= 1
+                bhi -= 1
+            if ahi < end:
+                matches.append((ahi, bhi, end - ahi))
+            if alo == ahi or blo == bhi:
+                continue
+
+            anchors = _unique_anchors(a, alo, ahi, b, blo, bhi)
+            if anchors is None:
+                # Nothing in common, the whole region is replaced
+                continue
+            if anchors:
+                for i, j in anchors:
+                    matches.append((i, j, 1))
+                    queue.append((alo, i, blo, j))
+                    alo, blo = i + 1, j + 1
+                queue.append((alo, ahi, blo, bhi))
+                continue
+
+            snake = _middle_snake(a, alo, ahi, b, blo, bhi, self.max_cost)
+            if snake is None:
+                # Too many edits, leave the region as replaced
+                continue
+            d, x0, y0, x1, y1 = snake
+            if x1 > x0:
+                matches.append((alo + x0, blo + y0, x1 - x0))
+            if d > 1 or x1 > x0:
+                queue.append((alo, alo + x0, blo, blo + y0))
+                queue.append((alo + x1, ahi, blo + y1, bhi))
+            # With d <= 1 and an empty snake, the prefix and suffix stripping
+            # above have already matched everything but the one edit
+
+        matches.sort()
+
+        # Collapse adjacent blocks like SequenceMatcher does
+        i1 = j1 = k1 = 0
+        non_adjacent = []
+        for i2, j2, k2 in matches:
+            if i1 + k1 == i2 and j1 + k1 == j2:
+                k1 += k2
+            else:
+                if k1:
+                    non_adjacent.append((i1, j1, k1))
+                i1, j1, k1 = i2, j2, k2
+        if k1:
+            non_adjacent.append((i1, j1, k1))
+
+        non_adjacent.append((la, lb, 0))
+        self.matching_blocks = list(map(Match._make, non_adjacent))
+        return self.matching_blocks
+
+class PatienceDiffer(Differ):
+    """
+    Differ that matches the lines with PatienceSequenceMatcher and limits the
+    intraline highlighting to blocks within the budget. Lines with the same
+    key(line), and the pairs of replaced lines accepted by linematch, are
+    shown as unchanged, as they are on the "from" side.
+    """
+
+    def __init__(self, linejunk=None, charjunk=IS_CHARACTER_JUNK, max_cost=500,
+                 intraline_max_lines=100, intraline_max_length=1000, key=None,
+                 linematch=None):
+        Differ.__init__(self, linejunk, charjunk)
+        self.max_cost = max_cost
+        self.key = key
+        self.linematch = linematch
+        self.intraline_max_lines = intraline_max_lines
+        self.intraline_max_length = intraline_max_length
+
+    def compare(self, a, b):
+        """Compare two sequences of lines; generate the resulting delta."""
+        cruncher = PatienceSequenceMatcher(None, a, b, max_cost=self.max_cost, key=self.key)
+        for tag, alo, ahi, blo, bhi in self._match_replaced(a, b, cruncher.get_opcodes()):
+            if tag == 'replace':
+                g = self._fancy_replace(a, alo, ahi, b, blo, bhi)
+            elif tag == 'delete':
+                g = self._dump('-', a, alo, ahi)
+            elif tag == 'insert':
+                g = self._dump('+', b, blo, bhi)
+            elif tag == 'equal':
+                g = self._dump(' ', a, alo, ahi)
+            else:
+                raise ValueError('unknown tag %r' % (tag,))
+
+            yield from g
+
+    def _match_replaced(self, a, b, opcodes):
+        """
+        Splits the replace opcodes into equal and replaced runs by pairing
+        their lines in order and checking the pairs with linematch.
+        """
+        for tag, alo, ahi, blo, bhi in opcodes:
+            if tag != 'replace' or self.linematch is None:
+                yield tag, alo, ahi, blo, bhi
+                continue
+            i, j = alo, blo
+            while i < ahi and j < bhi:
+                equal = self.linematch(a[i], b[j])
+                n = 1
+                while i + n < ahi and j + n < bhi and \
+                        self.linematch(a[i + n], b[j + n]) == equal:
+                    n += 1
+                if equal:
+                    yield 'equal', i, i + n, j, j + n
+                    i, j = i + n, j + n
+                elif i + n < ahi and j + n < bhi:
+                    yield 'replace', i, i + n, j, j + n
+                    i, j = i + n, j + n
+                else:
+                    # The rest of the block doesn't pair up
+                    break
+            if i < ahi and j < bhi:
+                yield 'replace', i, ahi, j, bhi
+            elif i < ahi:
+                yield 'delete', i, ahi, j, j
+            elif j < bhi:
+                yield 'insert', i, i, j, bhi
+
+    def _within_budget(self, a, alo, ahi, b, blo, bhi):
+        if ahi - alo > self.intraline_max_lines or bhi - blo > self.intraline_max_lines:
+            return False
+        max_length = self.intraline_max_length
+        return all(len(a[i]) <= max_length for i in range(alo, ahi)) and \
+               all(len(b[j]) <= max_length for j in range(blo, bhi))
+
+    def _fancy_replace(self, a, alo, ahi, b, blo, bhi):
+        if self._within_budget(a, alo, ahi, b, blo, bhi):
+            yield from Differ._fancy_replace(self, a, alo, ahi, b, blo, bhi)
+        else:
+            yield from self._plain_replace(a, alo, ahi, b, blo, bhi)